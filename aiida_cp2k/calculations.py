@@ -9,11 +9,22 @@
 
 from __future__ import absolute_import
 
+from collections import defaultdict, OrderedDict
+import hashlib
 import io
 import re
 import six
+import numpy as np
 from aiida.engine import CalcJob
-from aiida.orm import Dict, SinglefileData, StructureData, RemoteData, BandsData
+from aiida.orm import (
+    Dict,
+    SinglefileData,
+    StructureData,
+    RemoteData,
+    BandsData,
+    ArrayData,
+    TrajectoryData,
+)
 from aiida.common import CalcInfo, CodeInfo, InputValidationError
 
 
@@ -34,18 +45,77 @@ def _validate_basissets_namespace(bsets_dict):
                     )
 
 
-def _find_basisset_in_input(symbol, bsname, bstype, basissets):
-    for feval in basissets.values():
-        for kwsym, bsets in feval.items():  # (symbol,{"TYPE[IDX]": BSET})
-            if kwsym != symbol:
-                continue
+def _index_basissets(basissets):
+    """Return the basis sets of all FORCE_EVALs indexed by (symbol, name) as (type label, node)"""
+
+    index = defaultdict(list)
 
+    for feval in basissets.values():
+        for symbol, bsets in feval.items():  # (symbol,{"TYPE[IDX]": BSET})
             for tlabel, bset in bsets.items():
-                if not tlabel.startswith(bstype):
-                    continue
+                index[symbol, bset.name].append((tlabel, bset))
+
+    return index
+
+
+def _find_basisset_in_index(symbols, bsname, bstype, index):
+    for symbol in symbols:
+        for tlabel, bset in index.get((symbol, bsname), ()):
+            if tlabel.startswith(bstype):
+                return bset
+
+
+def _index_pseudos(pseudos):
+    """Return the pseudopotentials indexed by (symbol, name)"""
+
+    return {(symbol, pseudo.name): pseudo for symbol, pseudo in pseudos.items()}
+
+
+def _kind_symbols(section):
+    """
+    Return the symbols under which the basis sets and pseudopotentials of a KIND section
+    are looked up in the input namespaces: the kind label and the ELEMENT (if given)
+    """
+
+    symbols = [section["_"]]
+    if "ELEMENT" in section:
+        symbols.append(section["ELEMENT"])
+
+    return symbols
+
+
+def _write_data_file(fname, nodes):
+    """
+    Write the given data nodes (basis sets or pseudopotentials) in CP2K format to a file,
+    every node only once. The content is cached by the set of node UUIDs if the cache is
+    enabled by setting AIIDA_CP2K_INPUT_CACHE to a directory.
+    """
+    from . import __version__
+    from .utils import get_disk_cache
+
+    unique_nodes = OrderedDict((node.uuid, node) for node in nodes)
 
-                if bset.name == bsname:
-                    return bset
+    cache = get_disk_cache("AIIDA_CP2K_INPUT_CACHE")
+
+    if cache is not None:
+        key = hashlib.sha256(
+            " ".join([__version__] + sorted(unique_nodes)).encode("utf-8")
+        ).hexdigest()
+        content = cache.get(key)
+    else:
+        content = None
+
+    if content is None:
+        with io.StringIO() as fhandle:
+            for node in unique_nodes.values():
+                node.to_cp2k(fhandle)
+            content = fhandle.getvalue().encode("utf-8")
+
+        if cache is not None:
+            cache.put(key, content)
+
+    with io.open(fname, mode="wb") as fhandle:
+        fhandle.write(content)
 
 
 class Cp2kCalculation(CalcJob):
@@ -60,6 +130,10 @@ class Cp2kCalculation(CalcJob):
     _DEFAULT_OUTPUT_FILE = "aiida.out"
     _DEFAULT_PROJECT_NAME = "aiida"
     _DEFAULT_RESTART_FILE_NAME = _DEFAULT_PROJECT_NAME + "-1.restart"
+    _DEFAULT_TRAJECT_POS_FILE_NAME = _DEFAULT_PROJECT_NAME + "-pos-1.xyz"
+    _DEFAULT_TRAJECT_VEL_FILE_NAME = _DEFAULT_PROJECT_NAME + "-vel-1.xyz"
+    _DEFAULT_TRAJECT_FRC_FILE_NAME = _DEFAULT_PROJECT_NAME + "-frc-1.xyz"
+    _DEFAULT_TRAJECT_DCD_FILE_NAME = _DEFAULT_PROJECT_NAME + "-pos-1.dcd"
     _DEFAULT_PARENT_CALC_FLDR_NAME = "parent_calc/"
     _DEFAULT_COORDS_FILE_NAME = "aiida.coords.xyz"
     _DEFAULT_PARSER = "cp2k"
@@ -153,73 +227,159 @@ class Cp2kCalculation(CalcJob):
             required=False,
             help="optional band structure",
         )
+        spec.output(
+            "output_step_arrays",
+            valid_type=ArrayData,
+            required=False,
+            help="optional energies and Mulliken analyses of all steps",
+        )
+        spec.output(
+            "output_trajectory",
+            valid_type=TrajectoryData,
+            required=False,
+            help="optional MD or geometry optimization trajectory",
+        )
+        spec.output(
+            "output_timings",
+            valid_type=ArrayData,
+            required=False,
+            help="optional timing report with the call counts and times of the subroutines",
+        )
 
     def _validate_basissets(self, inp):
-        for secpath, section in inp.param_iter(keywords=False, sections=True):
-            if secpath[-1].upper() == "KIND":
-                symbol = section["_"]
-
-                # the BASIS_SET keyword can be repeated, even for the same type
-                if "BASIS_SET" in section:
-                    bsnames = section["BASIS_SET"]
-
-                    # the keyword BASIS_SET can occur multiple times in which case
-                    # the specified basis sets are merged (given they match the same type)
-                    if isinstance(bsnames, six.string_types):
-                        bsnames = [bsnames]
-
-                    for bsname in bsnames:
-                        # test for new-style basis set specification
-                        try:
-                            bstype, bsname = bsname.split(maxsplit=1)
-                        except ValueError:
-                            bstype = "ORB"
-
-                        if not _find_basisset_in_input(
-                            symbol, bsname, bstype, self.inputs.basissets
-                        ):
-                            raise InputValidationError(
-                                (
-                                    "'BASIS_SET {bstype} {bsname}' for element {symbol}"
-                                    " not found in basissets input namespace"
-                                ).format(bsname=bsname, bstype=bstype, symbol=symbol)
-                            )
-
-                for bstype in ("AUX", "AUX_FIT", "LRI", "RI_AUX"):
-                    key = "{bstype}_BASIS_SET".format(bstype=bstype)
-                    if key in section and not _find_basisset_in_input(
-                        symbol, section[key], bstype, self.inputs.basissets
-                    ):
+        index = _index_basissets(self.inputs.basissets)
+
+        for _, section in inp.param_iter(keywords=False, section_names=["KIND"]):
+            symbols = _kind_symbols(section)
+
+            # the BASIS_SET keyword can be repeated, even for the same type
+            if "BASIS_SET" in section:
+                bsnames = section["BASIS_SET"]
+
+                # the keyword BASIS_SET can occur multiple times in which case
+                # the specified basis sets are merged (given they match the same type)
+                if isinstance(bsnames, six.string_types):
+                    bsnames = [bsnames]
+
+                for bsname in bsnames:
+                    # test for new-style basis set specification
+                    try:
+                        bstype, bsname = bsname.split(maxsplit=1)
+                    except ValueError:
+                        bstype = "ORB"
+
+                    if not _find_basisset_in_index(symbols, bsname, bstype, index):
                         raise InputValidationError(
                             (
-                                "BasisSet '{bsname}' ({bstype} type) for element {symbol}"
+                                "'BASIS_SET {bstype} {bsname}' for element {symbol}"
                                 " not found in basissets input namespace"
-                            ).format(bsname=bsname, bstype=bstype, symbol=symbol)
+                            ).format(bsname=bsname, bstype=bstype, symbol=symbols[0])
                         )
 
+            for bstype in ("AUX", "AUX_FIT", "LRI", "RI_AUX"):
+                key = "{bstype}_BASIS_SET".format(bstype=bstype)
+                if key not in section:
+                    continue
+
+                bsname = section[key]
+                if not _find_basisset_in_index(symbols, bsname, bstype, index):
+                    raise InputValidationError(
+                        (
+                            "BasisSet '{bsname}' ({bstype} type) for element {symbol}"
+                            " not found in basissets input namespace"
+                        ).format(bsname=bsname, bstype=bstype, symbol=symbols[0])
+                    )
+
     def _write_basissets(self, inp, folder):
         # inject basis set file into all FORCE_EVAL/DFT sections
-        for secpath, section in inp.param_iter(keywords=False, sections=True):
-            if secpath[-1].upper() == "DFT":
-                section["BASIS_SET_FILE_NAME"] = "BASIS_SETS"
-
-        with io.open(
-            folder.get_abs_path("BASIS_SETS"), mode="w", encoding="utf-8"
-        ) as fhandle:
-            for section in self.inputs.basissets.values():
-                for btypes in section.values():  # (symbol,{"TYPE[IDX]": BSET})
-                    for bset in btypes.values():
-                        bset.to_cp2k(fhandle)
+        inp.add_keyword_to_sections("DFT", "BASIS_SET_FILE_NAME", "BASIS_SETS")
+
+        _write_data_file(
+            folder.get_abs_path("BASIS_SETS"),
+            (
+                bset
+                for section in self.inputs.basissets.values()
+                for btypes in section.values()  # (symbol,{"TYPE[IDX]": BSET})
+                for bset in btypes.values()
+            ),
+        )
 
     def _validate_pseudos(self, inp):
-        raise RuntimeError("not yet implemented")
+        index = _index_pseudos(self.inputs.pseudos)
+
+        for _, section in inp.param_iter(keywords=False, section_names=["KIND"]):
+            if "POTENTIAL" not in section:
+                continue
+
+            # test for new-style pseudopotential specification
+            try:
+                ptype, pname = section["POTENTIAL"].split(maxsplit=1)
+            except ValueError:
+                ptype, pname = "GTH", section["POTENTIAL"]
+
+            symbols = _kind_symbols(section)
+            if not any((symbol, pname) in index for symbol in symbols):
+                raise InputValidationError(
+                    (
+                        "'POTENTIAL {ptype} {pname}' for element {symbol}"
+                        " not found in pseudos input namespace"
+                    ).format(pname=pname, ptype=ptype, symbol=symbols[0])
+                )
 
     def _write_pseudos(self, inp, folder):
+        # inject pseudopotential file into all FORCE_EVAL/DFT sections
+        inp.add_keyword_to_sections("DFT", "POTENTIAL_FILE_NAME", "POTENTIALS")
+
+        _write_data_file(
+            folder.get_abs_path("POTENTIALS"), self.inputs.pseudos.values()
+        )
+
+    def _coords_file_name(self, fileformat):
+        if fileformat == "XYZ":
+            return self._DEFAULT_COORDS_FILE_NAME
+
+        return "{}.coords.{}".format(self._DEFAULT_PROJECT_NAME, fileformat.lower())
+
+    def _write_structure(self, folder, fileformat):
+        """
+        Write the input structure in the given format (XYZ, CIF or PDB) directly from the
+        attributes of the StructureData. Without format, it is exported as XYZ by AiiDA.
+
+        :return: the format of the written file
+        """
+        from .utils import write_structure
+
+        structure = self.inputs.structure
+
+        if fileformat is None:
+            structure.export(
+                folder.get_abs_path(self._DEFAULT_COORDS_FILE_NAME), fileformat="xyz"
+            )
+            return "XYZ"
+
+        fileformat = fileformat.upper()
+        if fileformat not in ("XYZ", "CIF", "PDB"):
+            raise InputValidationError(
+                "unsupported structure_file_format '{}' in settings".format(fileformat)
+            )
+
         with io.open(
-            folder.get_abs_path("POTENTIALS"), mode="w", encoding="utf-8"
+            folder.get_abs_path(self._coords_file_name(fileformat)),
+            mode="w",
+            encoding="utf-8",
         ) as fhandle:
-            for pseudo in self.inputs.pseudos.values():
-                pseudo.to_cp2k(fhandle)
+            try:
+                write_structure(
+                    fhandle,
+                    structure.get_attribute("sites"),
+                    structure.get_attribute("kinds"),
+                    structure.get_attribute("cell"),
+                    fileformat,
+                )
+            except ValueError as exc:
+                six.raise_from(InputValidationError(str(exc)), exc)
+
+        return fileformat
 
     def prepare_for_submission(self, folder):
         """Create the input files from the input nodes passed to this instance of the `CalcJob`.
@@ -229,24 +389,35 @@ class Cp2kCalculation(CalcJob):
         """
         from .utils import Cp2kInput
 
+        if "settings" in self.inputs:
+            settings = self.inputs.settings.get_dict()
+        else:
+            settings = {}
+
         # create input structure
         if "structure" in self.inputs:
-            self.inputs.structure.export(
-                folder.get_abs_path(self._DEFAULT_COORDS_FILE_NAME), fileformat="xyz"
+            coords_file_format = self._write_structure(
+                folder, settings.pop("structure_file_format", None)
             )
 
         # create cp2k input file
         inp = Cp2kInput(self.inputs.parameters.get_dict())
         inp.add_keyword("GLOBAL/PROJECT", self._DEFAULT_PROJECT_NAME)
         if "structure" in self.inputs:
-            for i, letter in enumerate("ABC"):
+            coords_file_name = self._coords_file_name(coords_file_format)
+            if coords_file_format == "CIF":
+                # the fractional coordinates in the CIF file refer to its cell
                 inp.add_keyword(
-                    "FORCE_EVAL/SUBSYS/CELL/" + letter,
-                    "{:<15} {:<15} {:<15}".format(*self.inputs.structure.cell[i]),
+                    "FORCE_EVAL/SUBSYS/CELL/CELL_FILE_NAME", coords_file_name
                 )
+                inp.add_keyword("FORCE_EVAL/SUBSYS/CELL/CELL_FILE_FORMAT", "CIF")
+            else:
+                cell = np.array(self.inputs.structure.cell)
+                for i, letter in enumerate("ABC"):
+                    inp.add_keyword("FORCE_EVAL/SUBSYS/CELL/" + letter, cell[i])
             topo = "FORCE_EVAL/SUBSYS/TOPOLOGY"
-            inp.add_keyword(topo + "/COORD_FILE_NAME", self._DEFAULT_COORDS_FILE_NAME)
-            inp.add_keyword(topo + "/COORD_FILE_FORMAT", "XYZ")
+            inp.add_keyword(topo + "/COORD_FILE_NAME", coords_file_name)
+            inp.add_keyword(topo + "/COORD_FILE_FORMAT", coords_file_format)
 
         if self.inputs.basissets:
             self._validate_basissets(inp)
@@ -271,11 +442,6 @@ class Cp2kCalculation(CalcJob):
                     exc,
                 )
 
-        if "settings" in self.inputs:
-            settings = self.inputs.settings.get_dict()
-        else:
-            settings = {}
-
         # create code info
         codeinfo = CodeInfo()
         codeinfo.cmdline_params = settings.pop("cmdline", []) + [
@@ -310,6 +476,17 @@ class Cp2kCalculation(CalcJob):
         ]
         calcinfo.retrieve_list += settings.pop("additional_retrieve_list", [])
 
+        # the parser options are read by the parser from the settings input node
+        parser_options = settings.pop("parser_options", {})
+
+        if parser_options.get("trajectory", False):
+            calcinfo.retrieve_list += [
+                self._DEFAULT_TRAJECT_POS_FILE_NAME,
+                self._DEFAULT_TRAJECT_VEL_FILE_NAME,
+                self._DEFAULT_TRAJECT_FRC_FILE_NAME,
+                self._DEFAULT_TRAJECT_DCD_FILE_NAME,
+            ]
+
         # symlinks
         if "parent_calc_folder" in self.inputs:
             comp_uuid = self.inputs.parent_calc_folder.computer.uuid
@@ -3,7 +3,13 @@
 """Command line interface script to launch CP2K workchains"""
 
 from __future__ import absolute_import
+import glob
+import hashlib
+import io
+import os
 import re
+import time
+from collections import OrderedDict
 
 import click
 
@@ -12,68 +18,248 @@ from aiida.cmdline.utils import decorators
 
 from . import calculations
 
+SHA256_EXTRA = "aiida_cp2k_sha256"
+
+
+def _launch_options(func):
+    """Add the options for the resources and the input handling of a calculation"""
+
+    for option in reversed(
+        [
+            click.option(
+                "-m",
+                "--max-num-machines",
+                type=click.INT,
+                default=1,
+                show_default=True,
+                help="The maximum number of machines (compute nodes)",
+            ),
+            click.option(
+                "-p",
+                "--max-num-mpiprocs-per-machine",
+                type=click.INT,
+                default=1,
+                show_default=True,
+                help="The maximum number of MPI processes per machine",
+            ),
+            click.option(
+                "-w",
+                "--max-wallclock-seconds",
+                type=click.INT,
+                default=1800,
+                show_default=True,
+                help="the maximum wallclock time in seconds",
+            ),
+            click.option(
+                "--parse-input/--no-parse-input",
+                default=False,
+                show_default=True,
+                help="Parse the input file into the parameters instead of passing it through as is",
+            ),
+        ]
+    ):
+        func = option(func)
+
+    return func
+
+
+def _sha256sum(fname):
+    sha256 = hashlib.sha256()
+
+    with io.open(fname, mode="rb") as fhandle:
+        for chunk in iter(lambda: fhandle.read(65536), b""):
+            sha256.update(chunk)
+
+    return sha256.hexdigest()
+
+
+def _get_or_store_file(fname):
+    """
+    Return a stored SinglefileData for the given file, an already stored node
+    with the same content and file name is reused.
+    """
+
+    from aiida.orm import QueryBuilder, SinglefileData
+
+    checksum = _sha256sum(fname)
+
+    qbuilder = QueryBuilder()
+    qbuilder.append(
+        SinglefileData,
+        filters={
+            "extras.{}".format(SHA256_EXTRA): checksum,
+            "attributes.filename": os.path.basename(fname),
+        },
+    )
+    result = qbuilder.first()
+
+    if result is not None:
+        return result[0]
+
+    node = SinglefileData(file=fname)
+    node.store()
+    node.set_extra(SHA256_EXTRA, checksum)
+
+    return node
+
+
+def _safe_linkname(fname):
+    return re.sub("[^0-9a-zA-Z_]+", "_", fname)
+
+
+def _calculation_inputs(code, input_file, datafiles, parse_input, options):
+    """Return the inputs of a Cp2kCalculation for the given input file and data file nodes"""
+
+    from aiida.orm import Dict
+
+    if parse_input:
+        from aiida_cp2k.utils import parse_cp2k_input
+
+        # the preprocessor directives are expanded, hence included files need not be passed
+        with io.open(input_file, mode="r", encoding="utf-8") as fhandle:
+            parameters = Dict(
+                dict=parse_cp2k_input(fhandle, basedir=os.path.dirname(input_file))
+            )
+    else:
+        parameters = Dict()
+        datafiles = [_get_or_store_file(input_file)] + list(datafiles)
+
+    inputs = {
+        "code": code,
+        "parameters": parameters,
+        "file": {_safe_linkname(f.filename): f for f in datafiles},
+        "metadata": {"options": dict(options)},
+    }
+
+    if not parse_input:  # the input file is used as is
+        inputs["metadata"]["options"]["input_filename"] = datafiles[0].filename
+
+    return inputs
+
+
+def _resources_options(
+    max_num_machines, max_num_mpiprocs_per_machine, max_wallclock_seconds
+):
+    return {
+        "resources": {
+            "num_machines": max_num_machines,
+            "num_mpiprocs_per_machine": max_num_mpiprocs_per_machine,
+        },
+        "max_wallclock_seconds": max_wallclock_seconds,
+    }
+
 
 @calculations.command("oneshot")
 @options.CODE(required=True, type=types.CodeParamType(entry_point="cp2k"))
 @click.argument(
     "files", nargs=-1, type=click.Path(exists=True, resolve_path=True), required=True
 )
+@_launch_options
+@decorators.with_dbenv()
+def oneshot(
+    code,
+    files,
+    max_num_machines,
+    max_num_mpiprocs_per_machine,
+    max_wallclock_seconds,
+    parse_input,
+):
+    """Run a one-shot CP2K workchain with the given input file (first) and additional data files"""
+
+    from aiida.engine import launch
+    from aiida.plugins import CalculationFactory
+
+    inputs = _calculation_inputs(
+        code,
+        files[0],
+        [_get_or_store_file(f) for f in files[1:]],
+        parse_input,
+        _resources_options(
+            max_num_machines, max_num_mpiprocs_per_machine, max_wallclock_seconds
+        ),
+    )
+
+    click.echo("Running CP2K calculation...")
+    _, node = launch.run_get_node(CalculationFactory("cp2k"), **inputs)
+
+
+@calculations.command("batch")
+@options.CODE(required=True, type=types.CodeParamType(entry_point="cp2k"))
+@click.argument("inputs", nargs=-1, required=True)
 @click.option(
-    "-m",
-    "--max-num-machines",
-    type=click.INT,
-    default=1,
-    show_default=True,
-    help="The maximum number of machines (compute nodes)",
+    "-f",
+    "--file",
+    "shared_files",
+    multiple=True,
+    type=click.Path(exists=True, resolve_path=True),
+    help="A data file used by all calculations, can be given multiple times",
 )
+@_launch_options
 @click.option(
-    "-p",
-    "--max-num-mpiprocs-per-machine",
+    "-c",
+    "--max-concurrent",
     type=click.INT,
-    default=1,
+    default=0,
     show_default=True,
-    help="The maximum number of MPI processes per machine",
+    help="The maximum number of unfinished calculations at a time (0: no limit)",
 )
 @click.option(
-    "-w",
-    "--max-wallclock-seconds",
+    "--poll-interval",
     type=click.INT,
-    default=1800,
+    default=30,
     show_default=True,
-    help="the maximum wallclock time in seconds",
+    help="The seconds to wait between checks for finished calculations",
 )
 @decorators.with_dbenv()
-def oneshot(
-    code, files, max_num_machines, max_num_mpiprocs_per_machine, max_wallclock_seconds
+def batch(
+    code,
+    inputs,
+    shared_files,
+    max_num_machines,
+    max_num_mpiprocs_per_machine,
+    max_wallclock_seconds,
+    parse_input,
+    max_concurrent,
+    poll_interval,
 ):
-    """Run a one-shot CP2K workchain with the given input file (first) and additional data files"""
+    """
+    Submit a CP2K calculation to the daemon for every given input file or glob pattern
 
-    from aiida.orm import SinglefileData, Dict
-    from aiida.engine import launch
+    The data files are stored once (identified by their content and file name) and
+    shared by all calculations.
+    """
 
-    datafiles = [SinglefileData(file=f) for f in files]
-    cp2k_input = datafiles[0]
+    from aiida.engine import submit
+    from aiida.plugins import CalculationFactory
 
-    def safe_linkname(fname):
-        return re.sub("[^0-9a-zA-Z_]+", "_", fname)
+    input_files = []
+    for pattern in inputs:
+        fnames = sorted(glob.glob(pattern))
+        if not fnames:
+            raise click.BadParameter(
+                "no file matching '{}'".format(pattern), param_hint="INPUTS"
+            )
+        input_files += [os.path.abspath(f) for f in fnames]
 
-    from aiida.plugins import CalculationFactory
+    # the same file may be matched by multiple patterns
+    input_files = list(OrderedDict.fromkeys(input_files))
 
-    inputs = {
-        "code": code,
-        "parameters": Dict(),
-        "file": {safe_linkname(f.filename): f for f in datafiles},
-        "metadata": {
-            "options": {
-                "input_filename": cp2k_input.filename,
-                "resources": {
-                    "num_machines": max_num_machines,
-                    "num_mpiprocs_per_machine": max_num_mpiprocs_per_machine,
-                },
-                "max_wallclock_seconds": max_wallclock_seconds,
-            }
-        },
-    }
+    datafiles = [_get_or_store_file(f) for f in shared_files]
+    resources = _resources_options(
+        max_num_machines, max_num_mpiprocs_per_machine, max_wallclock_seconds
+    )
+    calculation = CalculationFactory("cp2k")
 
-    click.echo("Running CP2K calculation...")
-    _, node = launch.run_get_node(CalculationFactory("cp2k"), **inputs)
+    unfinished = []
+    for input_file in input_files:
+        while max_concurrent and len(unfinished) >= max_concurrent:
+            time.sleep(poll_interval)
+            unfinished = [node for node in unfinished if not node.is_terminated]
+
+        node = submit(
+            calculation,
+            **_calculation_inputs(code, input_file, datafiles, parse_input, resources)
+        )
+        unfinished.append(node)
+
+        click.echo("Submitted calculation {} for {}".format(node.pk, input_file))
@@ -8,14 +8,132 @@
 """AiiDA-CP2K output parser"""
 from __future__ import absolute_import
 
+import hashlib
 import io
+import mmap
 import os
 
+from six.moves import cPickle as pickle
+
 from aiida.parsers import Parser
 from aiida.common import OutputParsingError, NotExistent
 from aiida.engine import ExitCode
 
-from .utils import parse_cp2k_output, parse_cp2k_trajectory
+from . import __version__
+from .utils import (
+    get_disk_cache,
+    parse_cp2k_output,
+    parse_cp2k_trajectory,
+    parse_cp2k_xyz_trajectory,
+    parse_dcd_trajectory,
+)
+
+
+# the minimal total size of the files to parse in a pool of processes, below which
+# forking the processes takes longer than parsing the files one after the other
+POOL_MIN_SIZE = 64 * 1024 * 1024  # bytes
+
+
+def _read_stdout(fname, all_steps):
+    with io.open(fname, mode="rb") as fobj:
+        if not os.fstat(fobj.fileno()).st_size:  # empty files can not be mapped
+            return parse_cp2k_output(fobj, all_steps=all_steps)
+
+        # parse the raw bytes of the mapped file instead of reading it into memory,
+        # the pages can be shared among daemon workers parsing the same file
+        mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parse_cp2k_output(mapped, all_steps=all_steps)
+        finally:
+            mapped.close()
+
+
+def _read_restart(fname):
+    try:
+        with io.open(fname, mode="r", encoding="utf-8") as fobj:
+            return parse_cp2k_trajectory(fobj)
+    except Exception:  # an unreadable restart file simply gives no output structure
+        return None
+
+
+def _read_trajectory(fname, reader, stride):
+    try:
+        with io.open(fname, mode="rb") as fobj:
+            return reader(fobj, stride=stride)
+    except Exception:  # a corrupt trajectory file is skipped, not failing the parser
+        return None
+
+
+def _task_key(func, args):
+    """
+    Return the cache key for a parse task: the hash of the content of the file to parse,
+    the other arguments and the parser version, but not the location of the file.
+    """
+
+    fname, args = args[0], args[1:]
+
+    key = hashlib.sha256()
+    with io.open(fname, mode="rb") as fobj:
+        for chunk in iter(lambda: fobj.read(1024 * 1024), b""):
+            key.update(chunk)
+
+    for arg in (__version__, func.__name__) + args:
+        key.update(repr(getattr(arg, "__name__", arg)).encode("utf-8"))
+
+    return key.hexdigest()
+
+
+def _run_tasks(tasks, nprocs, cache=None):
+    """
+    Run the given independent parse tasks, in a pool of `nprocs` processes if more than 1
+    and the files to parse are at least POOL_MIN_SIZE bytes in total. The pool is forked
+    from the calling process, for the Cp2kParser the daemon worker, for every parse.
+
+    :param tasks: dictionary of name -> (function, args), with the file to parse as first argument
+    :param cache: optional DiskCache to look up and store the results of the tasks
+    :return: dictionary of name -> result
+    """
+
+    results = {}
+    keys = {}
+
+    if cache is not None:
+        tasks = dict(tasks)
+        for name, (func, args) in list(tasks.items()):
+            keys[name] = _task_key(func, args)
+            data = cache.get(keys[name])
+            if data is None:
+                continue
+
+            try:
+                results[name] = pickle.loads(data)
+            except Exception:  # a truncated or corrupt entry, parsed again
+                cache.delete(keys[name])
+            else:
+                del tasks[name]
+
+    if (
+        nprocs <= 1
+        or len(tasks) <= 1
+        or sum(os.path.getsize(args[0]) for _, args in tasks.values()) < POOL_MIN_SIZE
+    ):
+        computed = {name: func(*args) for name, (func, args) in tasks.items()}
+    else:
+        from concurrent.futures import ProcessPoolExecutor
+
+        with ProcessPoolExecutor(max_workers=min(nprocs, len(tasks))) as executor:
+            futures = {
+                name: executor.submit(func, *args)
+                for name, (func, args) in tasks.items()
+            }
+            computed = {name: future.result() for name, future in futures.items()}
+
+    if cache is not None:
+        for name, result in computed.items():
+            cache.put(keys[name], pickle.dumps(result, protocol=2))
+
+    results.update(computed)
+    return results
 
 
 class Cp2kParser(Parser):
@@ -31,30 +149,99 @@ class Cp2kParser(Parser):
         except NotExistent:
             return self.exit_codes.ERROR_NO_RETRIEVED_FOLDER
 
-        self._parse_stdout(out_folder)
+        options = self._get_parser_options()
+        results = _run_tasks(
+            self._get_parse_tasks(out_folder, options),
+            options.get("nprocs", 1),
+            # enabled by setting AIIDA_CP2K_PARSER_CACHE to a directory
+            get_disk_cache("AIIDA_CP2K_PARSER_CACHE"),
+        )
 
-        try:
-            structure = self._parse_trajectory(out_folder)
-            self.out("output_structure", structure)
-        except Exception:
-            pass
+        self._parse_stdout(results["stdout"])
+
+        structure = None
+        if results.get("restart") is not None:
+            try:
+                structure = self._parse_trajectory(results["restart"])
+                self.out("output_structure", structure)
+            except Exception:
+                structure = None
+
+        if options.get("trajectory", False):
+            trajectory = self._parse_trajectory_files(results, structure)
+            if trajectory is not None:
+                self.out("output_trajectory", trajectory)
 
         return ExitCode(0)
 
-    def _parse_stdout(self, out_folder):
-        """CP2K output parser"""
+    def _get_parser_options(self):
+        """Return the parser options given in the settings input of the calculation"""
+
+        try:
+            settings = self.node.inputs.settings
+        except AttributeError:
+            return {}
+
+        return settings.get_dict().get("parser_options", {})
 
-        from aiida.orm import BandsData, Dict
+    def _get_parse_tasks(self, out_folder, options):
+        """Return the independent tasks to parse the retrieved files"""
+
+        calc_cls = self.node.process_class
+        retrieved = out_folder._repository.list_object_names()
+        base_path = out_folder._repository._get_base_folder().abspath
 
         # since the _DEFAULT_OUTPUT_FILE is the redirected stdout, AiiDA will ensure
         # that the file is there, even if the command were to be completely invalid
-        abs_fn = os.path.join(
-            out_folder._repository._get_base_folder().abspath,
-            self.node.process_class._DEFAULT_OUTPUT_FILE,
-        )
+        tasks = {
+            "stdout": (
+                _read_stdout,
+                (
+                    os.path.join(base_path, calc_cls._DEFAULT_OUTPUT_FILE),
+                    options.get("all_steps", False),
+                ),
+            )
+        }
+
+        if calc_cls._DEFAULT_RESTART_FILE_NAME in retrieved:
+            tasks["restart"] = (
+                _read_restart,
+                (os.path.join(base_path, calc_cls._DEFAULT_RESTART_FILE_NAME),),
+            )
+
+        if options.get("trajectory", False):
+            stride = options.get("trajectory_stride", 1)
 
-        with io.open(abs_fn, mode="r", encoding="utf-8") as fobj:
-            result_dict = parse_cp2k_output(fobj)
+            for name, fname, reader in (
+                (
+                    "positions",
+                    calc_cls._DEFAULT_TRAJECT_POS_FILE_NAME,
+                    parse_cp2k_xyz_trajectory,
+                ),
+                (
+                    "velocities",
+                    calc_cls._DEFAULT_TRAJECT_VEL_FILE_NAME,
+                    parse_cp2k_xyz_trajectory,
+                ),
+                (
+                    "forces",
+                    calc_cls._DEFAULT_TRAJECT_FRC_FILE_NAME,
+                    parse_cp2k_xyz_trajectory,
+                ),
+                ("dcd", calc_cls._DEFAULT_TRAJECT_DCD_FILE_NAME, parse_dcd_trajectory),
+            ):
+                if fname in retrieved:
+                    tasks[name] = (
+                        _read_trajectory,
+                        (os.path.join(base_path, fname), reader, stride),
+                    )
+
+        return tasks
+
+    def _parse_stdout(self, result_dict):
+        """CP2K output parser"""
+
+        from aiida.orm import ArrayData, BandsData, Dict
 
         if "nwarnings" not in result_dict:
             raise OutputParsingError("CP2K did not finish properly.")
@@ -70,25 +257,86 @@ class Cp2kParser(Parser):
             self.out("output_bands", bnds)
             del result_dict["kpoint_data"]
 
+        if "step_arrays" in result_dict:
+            # the per-step values are stored as arrays, not as lists of dicts in output_parameters
+            arrays = ArrayData()
+            for name, array in result_dict.pop("step_arrays").items():
+                arrays.set_array(name, array)
+            self.out("output_step_arrays", arrays)
+
+        if "timings" in result_dict:
+            # the timing report as one array per column, indexed like the subroutines
+            timings = ArrayData()
+            for name, array in result_dict.pop("timings").items():
+                timings.set_array(name, array)
+            self.out("output_timings", timings)
+
         self.out("output_parameters", Dict(dict=result_dict))
 
-    def _parse_trajectory(self, out_folder):
+    def _parse_trajectory(self, data):
         """CP2K trajectory parser"""
 
         from ase import Atoms
         from aiida.orm import StructureData
 
-        fname = self.node.process_class._DEFAULT_RESTART_FILE_NAME
+        # the coordinates are given with kind labels, which need not be element symbols
+        symbols = [data["kinds"].get(s, s) for s in data["symbols"]]
+        atoms = Atoms(symbols=symbols, positions=data["positions"], cell=data["cell"])
 
-        if fname not in out_folder._repository.list_object_names():
-            raise Exception(
-                "parsing trajectory requested, but no trajectory file available"
-            )
+        return StructureData(ase=atoms)
 
-        # read restart file
-        abs_fn = os.path.join(out_folder._repository._get_base_folder().abspath, fname)
+    def _parse_trajectory_files(self, results, structure):
+        """CP2K multi-frame trajectory (positions, velocities, forces) parser"""
 
-        with io.open(abs_fn, mode="r", encoding="utf-8") as fobj:
-            atoms = Atoms(**parse_cp2k_trajectory(fobj))
+        from aiida.orm import TrajectoryData
 
-        return StructureData(ase=atoms)
+        positions = results.get("positions")
+        dcd = results.get("dcd")
+
+        # an empty positions file (e.g. killed before the first frame) gives no frames
+        if positions is not None and not len(positions["values"]):
+            positions = None
+
+        if positions is not None:
+            symbols = positions["symbols"]
+            trajectory_kwargs = {
+                "positions": positions["values"],
+                "stepids": positions["steps"],
+                "times": positions["times"],
+            }
+        elif dcd is not None and structure is not None:
+            # the DCD format does not contain the symbols
+            symbols = [site.kind_name for site in structure.sites]
+            trajectory_kwargs = {"positions": dcd["positions"]}
+        else:
+            return None
+
+        if dcd is not None and "cells" in dcd:
+            if len(dcd["cells"]) == len(trajectory_kwargs["positions"]):
+                trajectory_kwargs["cells"] = dcd["cells"]
+
+        velocities = results.get("velocities")
+        if velocities is not None:
+            if velocities["values"].shape == trajectory_kwargs["positions"].shape:
+                trajectory_kwargs["velocities"] = velocities["values"]
+            else:
+                self.logger.warning(
+                    "velocities not stored, their frames do not match the positions"
+                )
+
+        trajectory = TrajectoryData()
+        trajectory.set_trajectory(symbols, **trajectory_kwargs)
+
+        if positions is not None:
+            trajectory.set_array("energies", positions["energies"])
+
+        forces = results.get("forces")
+        if forces is not None:
+            if forces["values"].shape == trajectory_kwargs["positions"].shape:
+                trajectory.set_array("forces", forces["values"])
+            else:
+                self.logger.warning(
+                    "forces not stored, their frames do not match the positions"
+                )
+
+        return trajectory
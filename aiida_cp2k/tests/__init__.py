@@ -116,3 +116,16 @@ def gaussian_datatypes_available():
         return False
 
     return True
+
+
+def assert_equal_output(data, expected):
+    """Assert that two results of parse_cp2k_output are equal, including the timing arrays"""
+    import numpy as np
+
+    data, expected = dict(data), dict(expected)
+    timings, expected_timings = data.pop("timings", {}), expected.pop("timings", {})
+
+    assert data == expected
+    assert sorted(timings) == sorted(expected_timings)
+    for key, values in timings.items():
+        np.testing.assert_equal(values, expected_timings[key])
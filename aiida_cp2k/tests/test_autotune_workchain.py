@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the autotuning of the parallel layout"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+
+from . import get_computer, get_code
+
+
+@pytest.mark.process_execution
+def test_cp2k_autotune_workchain(new_workdir):
+    """Testing the Cp2kAutotuneWorkChain on H2O with different NGRIDS"""
+
+    import ase.build
+
+    from aiida.engine import run_get_node
+    from aiida.plugins import WorkflowFactory
+    from aiida.orm import Dict, Int, StructureData
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structure
+    atoms = ase.build.molecule("H2O")
+    atoms.center(vacuum=2.0)
+    structure = StructureData(ase=atoms)
+
+    # parameters
+    parameters = Dict(
+        dict={
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ]
+                },
+            }
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    inputs = {
+        "cp2k": {
+            "structure": structure,
+            "parameters": parameters,
+            "code": code,
+            "metadata": {"options": options},
+        },
+        "grid": Dict(dict={"FORCE_EVAL/DFT/MGRID/NGRIDS": [3, 4]}),
+        "max_scf": Int(2),
+    }
+
+    result, node = run_get_node(WorkflowFactory("cp2k.autotune"), **inputs)
+
+    assert node.is_finished_ok
+
+    layout = result["output_layout"].get_dict()
+    assert layout["FORCE_EVAL/DFT/MGRID/NGRIDS"] in (3, 4)
+    assert layout["total_time"] > 0.0
+
+    benchmarks = result["output_benchmarks"]
+    assert len(benchmarks.get_array("labels")) == 2
+
+    # the rows can be mapped back to their layouts
+    assert sorted(benchmarks.get_array("layout_FORCE_EVAL_DFT_MGRID_NGRIDS")) == [3, 4]
+
+    # the production run uses the full input with the best layout
+    params = result["production"]["output_parameters"].get_dict()
+    assert params["exceeded_walltime"] is False
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the automatic walltime restarts of the Cp2kBaseWorkChain"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+
+from . import get_computer, get_code
+
+
+@pytest.mark.process_execution
+def test_cp2k_base_workchain_restart(new_workdir):
+    """Testing the Cp2kBaseWorkChain restarting a calculation exceeding the walltime"""
+
+    import ase.build
+
+    from aiida.engine import run_get_node
+    from aiida.plugins import WorkflowFactory
+    from aiida.orm import Dict, Int, StructureData
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structure
+    atoms = ase.build.molecule("H2O")
+    atoms.center(vacuum=2.0)
+    structure = StructureData(ase=atoms)
+
+    # CP2K input
+    parameters = Dict(
+        dict={
+            "GLOBAL": {"RUN_TYPE": "GEO_OPT", "WALLTIME": "00:00:10"},  # too short
+            "MOTION": {
+                "GEO_OPT": {
+                    "MAX_FORCE": 1e-20,  # impossible to reach
+                    "MAX_ITER": 100000,  # run forever
+                }
+            },
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                    "SCF": {"PRINT": {"RESTART": {"_": "ON"}}},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ]
+                },
+            },
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 2 * 60,
+    }
+
+    inputs = {
+        "cp2k": {
+            "structure": structure,
+            "parameters": parameters,
+            "code": code,
+            "metadata": {"options": options},
+        },
+        "max_iterations": Int(2),
+    }
+
+    _, node = run_get_node(WorkflowFactory("cp2k.base"), **inputs)
+
+    # the walltime is exceeded in every run
+    assert node.exit_status == 301
+
+    calcs = node.called
+    assert len(calcs) == 2
+
+    # the second calculation is started from the first one
+    restarted = [c for c in calcs if "parent_calc_folder" in c.inputs]
+    assert len(restarted) == 1
+
+    params = restarted[0].inputs.parameters.get_dict()
+    assert params["EXT_RESTART"]["RESTART_FILE_NAME"] == "parent_calc/aiida-1.restart"
+    assert params["FORCE_EVAL"]["DFT"]["SCF"]["SCF_GUESS"] == "RESTART"
+
+
+def test_add_walltime():
+    """Testing that the CP2K walltime is set below the scheduler limit"""
+
+    pytest.importorskip("aiida")
+
+    from aiida_cp2k.workflows import add_walltime
+
+    params = {"GLOBAL": {"RUN_TYPE": "GEO_OPT"}}
+
+    assert add_walltime(params, 24 * 3600)["GLOBAL"]["WALLTIME"] == 82080
+    assert add_walltime(params, 600)["GLOBAL"]["WALLTIME"] == 540
+    assert add_walltime(params, 100)["GLOBAL"]["WALLTIME"] == 50
+    assert "WALLTIME" not in params["GLOBAL"]
+
+    # a walltime set by the user is kept
+    params["GLOBAL"]["WALLTIME"] = "00:00:10"
+    assert add_walltime(params, 600)["GLOBAL"]["WALLTIME"] == "00:00:10"
@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""
+Throughput and memory benchmarks of the output parsers and the input generator
+
+The bundled output files and synthetic inputs and outputs are processed at increasing sizes.
+The scales are given as comma-separated list in AIIDA_CP2K_BENCHMARK_SCALES
+(default: 1,10), use for example "1,10,100,1000" to document the scaling.
+A minimal throughput in MB/s can be enforced with AIIDA_CP2K_BENCHMARK_MIN_MBS.
+The benchmarks are only run with `pytest --benchmark`, the measured numbers are recorded
+as properties of the test cases, for example in the report written with `--junitxml`.
+"""
+
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+
+import io
+import mmap
+import os
+import time
+from copy import deepcopy
+from os import path
+
+import pytest
+import six
+
+from aiida_cp2k.utils import (
+    Cp2kInput,
+    parse_cp2k_input,
+    parse_cp2k_output,
+    parse_cp2k_trajectory,
+    write_structure,
+    _parse_bands,
+)
+
+from . import assert_equal_output
+
+THISDIR = path.dirname(path.realpath(__file__))
+
+SCALES = [
+    int(s) for s in os.environ.get("AIIDA_CP2K_BENCHMARK_SCALES", "1,10").split(",")
+]
+MIN_MBS = float(os.environ.get("AIIDA_CP2K_BENCHMARK_MIN_MBS", 0))
+
+
+pytestmark = pytest.mark.benchmark
+
+
+@pytest.fixture(params=SCALES, ids="x{}".format)
+def scale(request):
+    """the factor by which the processed input or output is enlarged"""
+    return request.param
+
+
+@pytest.fixture
+def measure(record_property):
+    """
+    Return a function calling func with the given arguments and returning the result and the
+    peak of the Python memory allocations (None if not traceable). The wall time, the peak and,
+    if the processed `size` in bytes (or a function of the result giving it) is passed, the
+    throughput are recorded as properties of the test, and the minimal throughput is enforced.
+    The timing is done without tracing since tracemalloc slows down allocations.
+    """
+
+    def _measure(func, *args, **kwargs):
+        size = kwargs.pop("size", None)
+
+        start = time.time()
+        result = func(*args)
+        elapsed = time.time() - start
+        record_property("elapsed_s", elapsed)
+
+        peak = None
+        if not six.PY2:  # tracemalloc is not available
+            import tracemalloc
+
+            del result
+            tracemalloc.start()
+            try:
+                result = func(*args)
+                _, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+
+            record_property("peak_mb", peak / 1e6)
+
+        if size is not None:
+            if callable(size):
+                size = size(result)
+
+            throughput = size / 1e6 / max(elapsed, 1e-9)
+            record_property("throughput_mbs", throughput)
+            assert throughput >= MIN_MBS
+
+        return result, peak
+
+    return _measure
+
+
+def _parse_output_file(fname):
+    # the file is parsed like in the Cp2kParser: memory mapped
+    with io.open(fname, mode="rb") as fobj:
+        mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return parse_cp2k_output(mapped)
+        finally:
+            mapped.close()
+
+
+@pytest.mark.parametrize(
+    "fixture", ["cp2k_condnum_test01.out", "cp2k_mulliken_uks_test01.out"]
+)
+def test_output_parser(tmpdir, fixture, scale, measure):
+    with io.open(path.join(THISDIR, "files", fixture), mode="rb") as fobj:
+        content = fobj.read()
+
+    # repeated outputs give the same result since only the first match is stored
+    fname = str(tmpdir.join(fixture))
+    with io.open(fname, mode="wb") as fobj:
+        for _ in range(scale):
+            fobj.write(content)
+
+    size = path.getsize(fname)
+    result, peak = measure(_parse_output_file, fname, size=size)
+
+    assert_equal_output(
+        result, _parse_output_file(path.join(THISDIR, "files", fixture))
+    )
+
+    # the output is streamed, the memory must not grow with the file size
+    if peak is not None and scale > 1:
+        assert peak < size
+
+
+def _bands_lines(nkpoints, nbands=40, nspins=2):
+    lines = []
+
+    for kpoint in range(nkpoints):
+        coords = "  {:.8f}  {:.8f}  {:.8f}".format(kpoint / 10000, 0.0, 0.5)
+        for spin in range(1, nspins + 1):
+            lines.append(
+                " Nr. {:>3}    Spin {}    K-Point{}\n".format(kpoint + 1, spin, coords)
+            )
+            lines.append("  {:>5}\n".format(nbands))
+            for start in range(0, nbands, 4):
+                lines.append(
+                    "".join(
+                        "  {:>14.8f}".format(-5.0 + 0.25 * band + 0.001 * kpoint)
+                        for band in range(start, min(start + 4, nbands))
+                    )
+                    + "\n"
+                )
+
+    return lines
+
+
+def test_bands_parser(scale, measure):
+    nkpoints = 100 * scale
+    lines = _bands_lines(nkpoints)
+    size = sum(len(line) for line in lines)
+
+    (kpoints, _, bands), peak = measure(_parse_bands, lines, size=size)
+
+    assert kpoints.shape == (nkpoints, 3)
+    assert bands.shape == (2, nkpoints, 40)
+
+    # the bands are converted into a preallocated array (doubled when full),
+    # not kept as lists of floats
+    if peak is not None:
+        assert peak < 2 * size
+
+
+def _restart_file_content(natoms):
+    coords = "".join(
+        "H   {:.16E}    {:.16E}    {:.16E}       MOL 1\n".format(0.1 * i, 0.0, 1.0)
+        for i in range(natoms)
+    )
+    return u"""\
+ &FORCE_EVAL
+   &SUBSYS
+     &CELL
+       A     1.0000000000000000E+01    0.0000000000000000E+00    0.0000000000000000E+00
+       B     0.0000000000000000E+00    1.0000000000000000E+01    0.0000000000000000E+00
+       C     0.0000000000000000E+00    0.0000000000000000E+00    1.0000000000000000E+01
+     &END CELL
+     &COORD
+{}     &END COORD
+     &KIND H
+       ELEMENT  H
+     &END KIND
+   &END SUBSYS
+ &END FORCE_EVAL
+""".format(
+        coords
+    )
+
+
+def _parse_restart_file(fname):
+    with io.open(fname, mode="r", encoding="utf-8") as fobj:
+        return parse_cp2k_trajectory(fobj)
+
+
+def test_restart_parser(tmpdir, scale, measure):
+    natoms = 1000 * scale
+
+    fname = str(tmpdir.join("aiida-1.restart"))
+    with io.open(fname, mode="w", encoding="utf-8") as fobj:
+        fobj.write(_restart_file_content(natoms))
+
+    size = path.getsize(fname)
+    result, peak = measure(_parse_restart_file, fname, size=size)
+
+    assert result["positions"].shape == (natoms, 3)
+
+    # the file is streamed, but the coordinate fields are kept until the bulk conversion
+    if peak is not None:
+        assert peak < 4 * size
+
+
+def _mm_input(nkinds):
+    return {
+        "GLOBAL": {"RUN_TYPE": "MD"},
+        "FORCE_EVAL": {
+            "METHOD": "FIST",
+            "MM": {
+                "FORCEFIELD": {
+                    "CHARGE": [
+                        {"ATOM": "A{}".format(i), "CHARGE": 0.001 * i}
+                        for i in range(nkinds)
+                    ],
+                    "BOND": [
+                        {"ATOMS": "A{} A{}".format(i, i + 1), "K": 0.5, "R0": 1.1}
+                        for i in range(nkinds)
+                    ],
+                }
+            },
+            "SUBSYS": {
+                "KIND": [
+                    {"_": "A{}".format(i), "ELEMENT": "C", "MASS": 12.0}
+                    for i in range(nkinds)
+                ]
+            },
+        },
+    }
+
+
+def _prepare_input(params):
+    # the steps done with the input parameters in Cp2kCalculation.prepare_for_submission
+    inp = Cp2kInput(params)
+    inp.add_keyword("GLOBAL/PROJECT", "aiida")
+    for letter in "ABC":
+        inp.add_keyword("FORCE_EVAL/SUBSYS/CELL/" + letter, "10.0 10.0 10.0")
+    inp.add_keyword_to_sections("DFT", "BASIS_SET_FILE_NAME", "BASIS_SETS")
+    return inp
+
+
+def _prepare_input_deepcopy(params):
+    # the same steps with the full copy of the parameters done before on construction
+    return _prepare_input(deepcopy(params))
+
+
+def test_input_construction(scale, measure, record_property):
+    params = _mm_input(1000 * scale)
+    expected = deepcopy(params)
+
+    inp, _ = measure(_prepare_input, params)
+
+    # the baseline for the savings, only recorded since the ratio of timings is unreliable
+    start = time.time()
+    _prepare_input_deepcopy(params)
+    record_property("deepcopy_elapsed_s", time.time() - start)
+
+    # the passed-in dictionary is not changed
+    assert params == expected
+
+    # only the containers along the paths of the added keywords are copied,
+    # the untouched subtrees are shared with the passed-in dictionary
+    new_params = inp._params  # pylint: disable=protected-access
+    assert new_params is not params
+    assert new_params["FORCE_EVAL"] is not params["FORCE_EVAL"]
+    assert new_params["FORCE_EVAL"]["SUBSYS"] is not params["FORCE_EVAL"]["SUBSYS"]
+    assert new_params["FORCE_EVAL"]["MM"] is params["FORCE_EVAL"]["MM"]
+    assert (
+        new_params["FORCE_EVAL"]["SUBSYS"]["KIND"]
+        is params["FORCE_EVAL"]["SUBSYS"]["KIND"]
+    )
+
+
+def test_param_iter(scale, measure):
+    nkinds = 1000 * scale
+    inp = Cp2kInput(_mm_input(nkinds))
+
+    def kinds():
+        return list(inp.param_iter(keywords=False, section_names=["KIND"]))
+
+    result, _ = measure(kinds)
+
+    assert len(result) == nkinds
+
+
+def test_input_rendering(scale, measure):
+    inp = Cp2kInput(_mm_input(1000 * scale))
+
+    def render():
+        fhandle = io.StringIO()
+        inp.to_file(fhandle)
+        return fhandle.getvalue()
+
+    measure(render, size=len)
+
+
+def test_input_parsing(scale, measure):
+    content = six.text_type(Cp2kInput(_mm_input(1000 * scale)).to_string())
+
+    def parse():
+        with io.StringIO(content) as fhandle:
+            return parse_cp2k_input(fhandle)
+
+    result, _ = measure(parse, size=len(content))
+
+    assert len(result["FORCE_EVAL"]["SUBSYS"]["KIND"]) == 1000 * scale
+
+
+def test_array_rendering(scale, measure):
+    import numpy as np
+
+    natoms = 10000 * scale
+    coords = np.zeros(natoms, dtype=[("kind", "U2"), ("pos", np.float64, 3)])
+    coords["kind"] = "H"
+    coords["pos"] = np.random.RandomState(0).rand(natoms, 3)
+
+    inp = Cp2kInput({"FORCE_EVAL": {"SUBSYS": {"COORD": {" ": coords}}}})
+
+    result, _ = measure(inp.to_string, size=len)
+
+    assert result.count("\n") == natoms + 6
+
+
+@pytest.mark.parametrize("fileformat", ["XYZ", "CIF", "PDB"])
+def test_structure_writer(fileformat, scale, measure):
+    import numpy as np
+
+    natoms = 10000 * scale
+    positions = np.random.RandomState(0).rand(natoms, 3) * 10.0
+
+    # the attributes of a StructureData
+    sites = [{"kind_name": "H", "position": p} for p in positions.tolist()]
+    kinds = [{"name": "H", "symbols": ["H"]}]
+    cell = [[10.0, 0.0, 0.0], [0.0, 10.0, 0.0], [0.0, 0.0, 10.0]]
+
+    def write():
+        with io.StringIO() as fhandle:
+            write_structure(fhandle, sites, kinds, cell, fileformat)
+            return fhandle.getvalue()
+
+    measure(write, size=len)
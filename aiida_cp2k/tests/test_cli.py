@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the command line interface"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import io
+import os
+
+import pytest
+
+from . import get_computer, get_code
+
+
+@pytest.mark.process_execution
+def test_calc_batch(new_workdir, new_filedir, monkeypatch):
+    """Testing the batch submission with shared data files and a concurrency limit"""
+
+    import aiida.engine
+    from click.testing import CliRunner
+
+    from aiida.orm import QueryBuilder, SinglefileData
+
+    from aiida_cp2k.cli import root
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    for fname in ("a.inp", "b.inp", "BASIS"):
+        with io.open(os.path.join(new_filedir, fname), mode="w") as fhandle:
+            fhandle.write("content of {}\n".format(fname))
+
+    class Node(object):
+        def __init__(self, pk):
+            self.pk = pk
+            self.is_terminated = False
+
+    submitted = []
+
+    def submit(_, **inputs):
+        submitted.append((Node(len(submitted)), inputs))
+        return submitted[-1][0]
+
+    sleeps = []
+
+    def sleep(_):
+        # all calculations submitted so far finish while waiting
+        sleeps.append(len(submitted))
+        for node, _ in submitted:
+            node.is_terminated = True
+
+    monkeypatch.setattr(aiida.engine, "submit", submit)
+    monkeypatch.setattr("time.sleep", sleep)
+
+    args = [
+        "calc",
+        "batch",
+        "--code",
+        str(code.pk),
+        "--file",
+        os.path.join(new_filedir, "BASIS"),
+        "--max-concurrent",
+        "1",
+        # the first input file is matched twice, but submitted once
+        os.path.join(new_filedir, "a.inp"),
+        os.path.join(new_filedir, "*.inp"),
+    ]
+
+    result = CliRunner().invoke(root, args)
+    assert result.exit_code == 0, result.output
+
+    options = [inputs["metadata"]["options"] for _, inputs in submitted]
+    assert [o["input_filename"] for o in options] == ["a.inp", "b.inp"]
+
+    # the second calculation waits for the first one
+    assert sleeps == [1]
+
+    # the shared file is stored once and reused when submitting again
+    basis_pks = set(inputs["file"]["BASIS"].pk for _, inputs in submitted)
+    assert len(basis_pks) == 1
+
+    result = CliRunner().invoke(root, args)
+    assert result.exit_code == 0, result.output
+    assert set(inputs["file"]["BASIS"].pk for _, inputs in submitted) == basis_pks
+
+    qbuilder = QueryBuilder()
+    qbuilder.append(SinglefileData, filters={"attributes.filename": "BASIS"})
+    assert qbuilder.count() == 1
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the parallel fan-out of template variations"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+
+from . import get_computer, get_code
+
+
+@pytest.mark.process_execution
+def test_cp2k_fanout_workchain(new_workdir):
+    """Testing the Cp2kFanOutWorkChain on H2O with varied cutoffs"""
+
+    import ase.build
+
+    from aiida.engine import run_get_node
+    from aiida.plugins import WorkflowFactory
+    from aiida.orm import Dict, Int, StructureData
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structure
+    atoms = ase.build.molecule("H2O")
+    atoms.center(vacuum=2.0)
+    structure = StructureData(ase=atoms)
+
+    # parameters
+    parameters = Dict(
+        dict={
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ]
+                },
+            }
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    cutoffs = [200, 240, 280]
+
+    inputs = {
+        "cp2k": {
+            "structure": structure,
+            "parameters": parameters,
+            "code": code,
+            "metadata": {"options": options},
+        },
+        "parameters": {
+            "cutoff_{}".format(cutoff): Dict(
+                dict={"FORCE_EVAL": {"DFT": {"MGRID": {"CUTOFF": cutoff}}}}
+            )
+            for cutoff in cutoffs
+        },
+        "max_in_flight": Int(2),
+    }
+
+    result, node = run_get_node(WorkflowFactory("cp2k.fanout"), **inputs)
+
+    assert node.is_finished_ok
+    assert len(node.called) == len(cutoffs) + 1  # and the collection of the results
+
+    table = result["output_table"]
+    assert list(table.get_array("labels")) == ["cutoff_{}".format(c) for c in cutoffs]
+    assert table.get_array("energy").shape == (len(cutoffs),)
+
+    # the template parameters are kept
+    for calc in node.called:
+        if "parameters" in calc.inputs:
+            params = calc.inputs.parameters.get_dict()
+            assert params["FORCE_EVAL"]["DFT"]["MGRID"]["NGRIDS"] == 4
@@ -42,6 +42,103 @@ BSET_INPUT = """\
       0.162491615040 -0.242351537800  1.102830348700 -0.257388983000  1.054102919900  0.152954188700
 """
 
+PSEUDO_INPUT = """\
+#
+H GTH-LDA-q1 GTH-LDA
+    1
+     0.20000000    2    -4.18023680     0.72507482
+    0
+#
+O GTH-LDA-q6 GTH-LDA
+    2    4
+     0.24762086    2   -16.58031797     2.39570092
+    2
+     0.22178614    1    18.26691718
+     0.25682890    0
+"""
+
+
+def test_basisset_index():
+    """Testing the lookup of the basis sets by kind symbol, name and type"""
+
+    from collections import namedtuple
+
+    from aiida_cp2k.calculations import _index_basissets, _find_basisset_in_index
+
+    BSet = namedtuple("BSet", ["name"])
+
+    orb_h, aux_h, orb_o = BSet("DZVP"), BSet("DZVP"), BSet("DZVP")
+    orb_h2 = BSet("TZVP")
+
+    index = _index_basissets(
+        {
+            "FORCE_EVAL_0": {
+                "H": {"ORB_0": orb_h, "AUX_FIT_0": aux_h},
+                "O": {"ORB": orb_o},
+            },
+            "FORCE_EVAL_1": {"H": {"ORB_0": orb_h2}},
+        }
+    )
+
+    # the same name for different symbols and types
+    assert _find_basisset_in_index(["H"], "DZVP", "ORB", index) is orb_h
+    assert _find_basisset_in_index(["H"], "DZVP", "AUX_FIT", index) is aux_h
+    assert _find_basisset_in_index(["O"], "DZVP", "ORB", index) is orb_o
+
+    # the basis sets of all FORCE_EVALs are indexed
+    assert _find_basisset_in_index(["H"], "TZVP", "ORB", index) is orb_h2
+
+    # a kind labeled differently is found by its element
+    assert _find_basisset_in_index(["H1", "H"], "DZVP", "ORB", index) is orb_h
+
+    # missing symbol, name or type
+    assert _find_basisset_in_index(["C"], "DZVP", "ORB", index) is None
+    assert _find_basisset_in_index(["O"], "TZVP", "ORB", index) is None
+    assert _find_basisset_in_index(["O"], "DZVP", "AUX_FIT", index) is None
+
+
+def test_write_data_file(tmpdir, monkeypatch):
+    """Testing that the data files contain every node once and are reproduced from the cache"""
+
+    from aiida.plugins import DataFactory
+
+    from aiida_cp2k.calculations import _write_data_file
+
+    BasisSet = DataFactory("gaussian.basisset")
+
+    bsets = {b.element: b for b in BasisSet.from_cp2k(StringIO(BSET_INPUT))}
+
+    # the expected content, every basis set written once
+    fhandle = StringIO()
+    bsets["H"].to_cp2k(fhandle)
+    bsets["O"].to_cp2k(fhandle)
+    expected = fhandle.getvalue().encode("utf-8")
+
+    # two kinds sharing the same basis set
+    nodes = [bsets["H"], bsets["O"], bsets["H"]]
+
+    fname = str(tmpdir.join("BASIS_SETS"))
+    _write_data_file(fname, nodes)
+    with open(fname, "rb") as fhandle:
+        assert fhandle.read() == expected
+
+    monkeypatch.setenv("AIIDA_CP2K_INPUT_CACHE", str(tmpdir.join("cache")))
+    _write_data_file(fname, nodes)
+
+    class CachedNode(object):
+        """A node which must not be written again since its content is cached"""
+
+        def __init__(self, node):
+            self.uuid = node.uuid
+
+        def to_cp2k(self, fhandle):
+            raise AssertionError("not read from the cache")
+
+    fname = str(tmpdir.join("BASIS_SETS_CACHED"))
+    _write_data_file(fname, [CachedNode(n) for n in reversed(nodes)])
+    with open(fname, "rb") as fhandle:
+        assert fhandle.read() == expected
+
 
 @pytest.mark.process_execution
 def test_gaussian_basisset_validation(new_workdir):
@@ -193,3 +290,176 @@ def test_gaussian_basisset_validation_failure(new_workdir):
 
     with pytest.raises(InputValidationError):
         run(CalculationFactory("cp2k"), **inputs)
+
+
+@pytest.mark.process_execution
+def test_gaussian_pseudo_validation_failure(new_workdir):
+    """Testing CP2K with the Pseudopotential stored in gaussian.pseudo but missing"""
+
+    import ase.build
+
+    from aiida.engine import run
+    from aiida.plugins import CalculationFactory, DataFactory
+    from aiida.orm import Dict, StructureData
+    from aiida.common.exceptions import InputValidationError
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structure
+    atoms = ase.build.molecule("H2O")
+    atoms.center(vacuum=2.0)
+    structure = StructureData(ase=atoms)
+
+    BasisSet = DataFactory("gaussian.basisset")
+    Pseudopotential = DataFactory("gaussian.pseudo")
+
+    fhandle = StringIO(BSET_INPUT)
+    bsets = {b.element: b for b in BasisSet.from_cp2k(fhandle)}
+
+    fhandle = StringIO(PSEUDO_INPUT)
+    pseudos = {p.element: p for p in Pseudopotential.from_cp2k(fhandle)}
+
+    # parameters
+    parameters = Dict(
+        dict={
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "POTENTIAL": "GTH " + pseudos["O"].name,
+                            "BASIS_SET": bsets["O"].name,
+                        },
+                        {
+                            "_": "H",
+                            "POTENTIAL": "GTH " + pseudos["H"].name,
+                            "BASIS_SET": bsets["H"].name,
+                        },
+                    ]
+                },
+            }
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    inputs = {
+        "structure": structure,
+        "parameters": parameters,
+        "code": code,
+        "metadata": {"options": options},
+        "basissets": {
+            "FORCE_EVAL_0": {
+                element: {"ORB_0": bset} for element, bset in bsets.items()
+            }
+        },
+        # add only one of the pseudopotentials to inputs
+        "pseudos": {"H": pseudos["H"]},
+    }
+
+    with pytest.raises(InputValidationError):
+        run(CalculationFactory("cp2k"), **inputs)
+
+
+@pytest.mark.process_execution
+def test_gaussian_pseudo_validation(new_workdir):
+    """Testing CP2K with the Pseudopotentials stored in gaussian.pseudo"""
+
+    import ase.build
+
+    from aiida.engine import run_get_node
+    from aiida.plugins import CalculationFactory, DataFactory
+    from aiida.orm import Dict, StructureData
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structure
+    atoms = ase.build.molecule("H2O")
+    atoms.center(vacuum=2.0)
+    structure = StructureData(ase=atoms)
+
+    BasisSet = DataFactory("gaussian.basisset")
+    Pseudopotential = DataFactory("gaussian.pseudo")
+
+    fhandle = StringIO(BSET_INPUT)
+    bsets = {b.element: b for b in BasisSet.from_cp2k(fhandle)}
+
+    fhandle = StringIO(PSEUDO_INPUT)
+    pseudos = {p.element: p for p in Pseudopotential.from_cp2k(fhandle)}
+
+    # parameters, with the plain and the new-style specification of the pseudopotential
+    parameters = Dict(
+        dict={
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "POTENTIAL": "GTH " + pseudos["O"].name,
+                            "BASIS_SET": bsets["O"].name,
+                        },
+                        {
+                            "_": "H",
+                            "POTENTIAL": pseudos["H"].name,
+                            "BASIS_SET": bsets["H"].name,
+                        },
+                    ]
+                },
+            }
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    inputs = {
+        "structure": structure,
+        "parameters": parameters,
+        "code": code,
+        "metadata": {"options": options},
+        "basissets": {
+            "FORCE_EVAL_0": {
+                element: {"ORB_0": bset} for element, bset in bsets.items()
+            }
+        },
+        "pseudos": pseudos,
+    }
+
+    _, node = run_get_node(CalculationFactory("cp2k"), **inputs)
+
+    # the pseudopotentials file is written and referenced in the input file
+    assert "POTENTIALS" in node.list_object_names()
+    assert "POTENTIAL_FILE_NAME POTENTIALS" in node.get_object_content("aiida.inp")
+
+    potentials = node.get_object_content("POTENTIALS")
+    assert pseudos["H"].name in potentials
+    assert pseudos["O"].name in potentials
@@ -9,8 +9,10 @@
 from __future__ import absolute_import
 
 import io
+import json
 
 import pytest
+import six
 
 from aiida_cp2k.utils import Cp2kInput
 
@@ -72,6 +74,52 @@ def test_add_keyword_invariant_input():
     assert inp.to_string() == inp.to_string()
 
 
+def test_add_keyword_invariant_nested_input():
+    param = {"FORCE_EVAL": {"DFT": {"FOO": "bar"}, "MM": {"BAR": "foo"}}}
+    inp = Cp2kInput(param)
+    inp.add_keyword("FORCE_EVAL/DFT/BAR", "boo")
+    inp.add_keyword("FORCE_EVAL/DFT/BAZ", "boo")
+
+    assert inp.params == {
+        "FORCE_EVAL": {
+            "DFT": {"FOO": "bar", "BAR": "boo", "BAZ": "boo"},
+            "MM": {"BAR": "foo"},
+        }
+    }
+    assert param == {"FORCE_EVAL": {"DFT": {"FOO": "bar"}, "MM": {"BAR": "foo"}}}
+
+    # the unchanged sections are shared, not copied
+    assert inp._params["FORCE_EVAL"]["MM"] is param["FORCE_EVAL"]["MM"]
+
+
+def test_add_keyword_to_sections():
+    param = {"FORCE_EVAL": [{"DFT": {"FOO": "bar"}}, {"MM": {}}, {"DFT": {}}]}
+    inp = Cp2kInput(param)
+    inp.add_keyword_to_sections("DFT", "BAR", "boo")
+
+    assert inp.params == {
+        "FORCE_EVAL": [
+            {"DFT": {"FOO": "bar", "BAR": "boo"}},
+            {"MM": {}},
+            {"DFT": {"BAR": "boo"}},
+        ]
+    }
+    assert param == {"FORCE_EVAL": [{"DFT": {"FOO": "bar"}}, {"MM": {}}, {"DFT": {}}]}
+
+
+def test_params_copy():
+    params = {"FOO": {"BAR": ["boo"]}}
+    inp = Cp2kInput(params)
+
+    # a plain dictionary which can be changed without changing the input
+    inp_params = inp.params
+    assert isinstance(inp_params, dict)
+    inp_params["FOO"]["BAR"][0] = "bar"
+
+    assert inp.params["FOO"]["BAR"] == ["boo"]
+    assert json.loads(json.dumps(inp.params)) == params
+
+
 def test_multiple_force_eval():
     inp = Cp2kInput({"FORCE_EVAL": [{"FOO": "bar"}, {"FOO": "bar"}, {"FOO": "bar"}]})
     assert (
@@ -105,6 +153,61 @@ def test_kinds():
     )
 
 
+def test_repeated_keywords():
+    inp = Cp2kInput({"SEC": {"FOO": [True, 1, "bar"], "&BAR": [{"_": 1.5}, [False]]}})
+    assert (
+        inp.to_string()
+        == """{inp.DISCLAIMER}
+&SEC
+   &BAR 1.5
+   &END BAR
+   BAR .FALSE.
+   FOO .TRUE.
+   FOO 1
+   FOO bar
+&END SEC""".format(
+            inp=inp
+        )
+    )
+
+
+def test_array_values():
+    import numpy as np
+
+    coords = np.zeros(2, dtype=[("kind", "U2"), ("pos", np.float64, 3)])
+    coords["kind"] = ["H", "O"]
+    coords["pos"] = [[0.1, 0.0, 1.0 / 3.0], [2.0, 1e-12, -1.5]]
+
+    inp = Cp2kInput(
+        {
+            "CELL": {
+                "A": np.array([5.0, 0.0, 0.0]),
+                "MULTIPLE_UNIT_CELL": np.ones(3, int),
+            },
+            "COORD": {" ": coords},
+            "VELOCITY": {" ": np.zeros((0, 3))},
+            "FIXED": np.array([True, False]),
+        }
+    )
+    assert (
+        inp.to_string()
+        == """{inp.DISCLAIMER}
+&CELL
+   A 5.0 0.0 0.0
+   MULTIPLE_UNIT_CELL 1 1 1
+&END CELL
+&COORD
+     H 0.1 0.0 0.3333333333333333
+     O 2.0 1e-12 -1.5
+&END COORD
+FIXED .TRUE. .FALSE.
+&VELOCITY
+&END VELOCITY""".format(
+            inp=inp
+        )
+    )
+
+
 def test_invariant_under_render():
     param = {"KIND": [{"_": "H"}, {"_": "O"}]}
     Cp2kInput(param).to_string()
@@ -174,6 +277,22 @@ def test_param_iter():
     ]
 
 
+def test_param_iter_sections():
+    inp = Cp2kInput(
+        {
+            "FORCE_EVAL": {
+                "DFT": {"FOO": "bar"},
+                "SUBSYS": {"KIND": [{"_": "H"}, {"_": "O"}], "COORD": ["H 0 0 0"]},
+            }
+        }
+    )
+    assert list(inp.param_iter(keywords=False, section_names=["kind", "DFT"])) == [
+        (("FORCE_EVAL", "DFT"), {"FOO": "bar"}),
+        (("FORCE_EVAL", "SUBSYS", "KIND"), {"_": "H"}),
+        (("FORCE_EVAL", "SUBSYS", "KIND"), {"_": "O"}),
+    ]
+
+
 def test_string_file_equal_output():
     params = {
         "FORCE_EVAL": {
@@ -278,3 +397,139 @@ def test_string_file_equal_output():
     with io.StringIO() as fhandle:
         inp.to_file(fhandle)
         assert inp.to_string() == fhandle.getvalue()
+
+
+def test_parse_input():
+    from aiida_cp2k.utils import parse_cp2k_input
+
+    content = u"""\
+@SET FUNC PBE
+&FORCE_EVAL
+  METHOD Quickstep  ! comment
+  &DFT
+    UKS
+    &XC
+      &XC_FUNCTIONAL ${FUNC}
+      &END XC_FUNCTIONAL
+    &END XC
+@IF $FUNC == PBE
+    &PRINT
+      &MO  # a section and a keyword with the same name
+      &END MO
+      mo .TRUE.
+    &END PRINT
+@ENDIF
+@IF ${FUNC} /= PBE
+    CHARGE ${UNDEFINED}
+@ENDIF
+  &END DFT
+  &SUBSYS
+    &COORD
+      UNIT angstrom
+      H 0.0 0.0 \\
+        0.74
+      H 0.0 0.0 0.0
+    &END COORD
+    &KIND H
+    &END KIND
+    &KIND O
+    &END KIND
+  &END SUBSYS
+&END FORCE_EVAL
+"""
+
+    with io.StringIO(content) as fhandle:
+        params = parse_cp2k_input(fhandle)
+
+    assert params == {
+        "FORCE_EVAL": {
+            "METHOD": "Quickstep",
+            "DFT": {
+                "UKS": True,
+                "XC": {"XC_FUNCTIONAL": {"_": "PBE"}},
+                "PRINT": {"&MO": {}, "MO": ".TRUE."},
+            },
+            "SUBSYS": {
+                "COORD": {
+                    "UNIT": "angstrom",
+                    " ": ["H 0.0 0.0  0.74", "H 0.0 0.0 0.0"],
+                },
+                "KIND": [{"_": "H"}, {"_": "O"}],
+            },
+        }
+    }
+
+
+def test_parse_input_include(tmpdir):
+    from aiida_cp2k.utils import parse_cp2k_input
+
+    tmpdir.join("kind.inc").write("&KIND ${ELEMENT}\n  ELEMENT ${ELEMENT}\n&END KIND\n")
+
+    content = u"&SUBSYS\n  @INCLUDE 'kind.inc'\n&END SUBSYS\n"
+
+    with io.StringIO(content) as fhandle:
+        params = parse_cp2k_input(
+            fhandle, basedir=str(tmpdir), variables={"ELEMENT": "Si"}
+        )
+
+    assert params == {"SUBSYS": {"KIND": {"_": "Si", "ELEMENT": "Si"}}}
+
+
+def test_parse_input_errors():
+    from aiida_cp2k.utils import parse_cp2k_input
+
+    for content in (
+        u"&FOO\n",
+        u"&FOO\n&END BAR\n",
+        u"FOO ${BAR}\n",
+        u"@IF 1\nFOO\n",
+        u"@XCTYPE PBE\n",
+    ):
+        with pytest.raises(ValueError):
+            with io.StringIO(content) as fhandle:
+                parse_cp2k_input(fhandle)
+
+
+def test_parse_input_rendered():
+    from aiida_cp2k.utils import parse_cp2k_input
+
+    inp = Cp2kInput(
+        {
+            "FORCE_EVAL": [{"METHOD": "FIST"}, {"METHOD": "Quickstep"}],
+            "MOTION": {"MD": {"STEPS": 10, "TIMESTEP": 0.5}},
+            "GLOBAL": {"EXTENDED_FFT_LENGTHS": True, "PRINT_LEVEL": "LOW"},
+            "KPOINT_SET": {"SPECIAL_POINT": ["GAMMA 0.0 0.0 0.0", "L 0.5 0.5 0.5"]},
+        }
+    )
+
+    with io.StringIO(six.text_type(inp.to_string())) as fhandle:
+        assert Cp2kInput(parse_cp2k_input(fhandle)).to_string() == inp.to_string()
+
+
+def test_write_structure():
+    from aiida_cp2k.utils import write_structure
+
+    sites = [
+        {"kind_name": "H", "position": (0.1, 0.0, 1.0 / 3.0)},
+        {"kind_name": "O1", "position": (2.0, 1.0, 1.5)},
+    ]
+    kinds = [{"name": "H", "symbols": ["H"]}, {"name": "O1", "symbols": ["O"]}]
+    cell = [[5.0, 0.0, 0.0], [0.0, 6.0, 0.0], [0.0, 0.0, 7.0]]
+
+    with io.StringIO() as fhandle:
+        write_structure(fhandle, sites, kinds, cell, "xyz")
+        assert fhandle.getvalue() == "2\n\nH 0.1 0.0 0.3333333333333333\nO1 2.0 1.0 1.5\n"
+
+    with io.StringIO() as fhandle:
+        write_structure(fhandle, sites, kinds, cell, "cif")
+        lines = fhandle.getvalue().splitlines()
+        assert "_cell_angle_beta 90.0" in lines
+        assert lines[-1] == "O1 O 0.4 0.16666666666666666 0.21428571428571427"
+
+    with io.StringIO() as fhandle:
+        write_structure(fhandle, sites, kinds, cell, "pdb")
+        lines = fhandle.getvalue().splitlines()
+        assert lines[1][12:16] == "O1  "
+        assert [float(lines[1][i : i + 8]) for i in (30, 38, 46)] == [2.0, 1.0, 1.5]
+        assert lines[1][76:78] == " O"
+        assert lines[-1] == "END"
@@ -9,11 +9,16 @@
 from __future__ import absolute_import
 
 import io
+import os
+import tempfile
 from os import path
 
 import numpy as np
+import pytest
 from aiida_cp2k.utils import parse_cp2k_output
 
+from . import assert_equal_output
+
 
 TEST_DIR = path.dirname(path.realpath(__file__))
 
@@ -119,3 +124,518 @@ def test_mulliken_uks():
         expected_pa, [[line[f] for f in fields] for line in results["per-atom"]]
     )
     assert set(l["element"] for l in results["per-atom"]) == {"Fe"}
+
+
+def test_streaming_equal_output():
+    with io.open(
+        path.join(TEST_DIR, "files/cp2k_mulliken_uks_test01.out"), "r"
+    ) as fobj:
+        data = parse_cp2k_output(fobj)
+
+    # the parser must work on any iterable of lines, without reading the complete file
+    with io.open(
+        path.join(TEST_DIR, "files/cp2k_mulliken_uks_test01.out"), "r"
+    ) as fobj:
+        streamed_data = parse_cp2k_output(line for line in fobj)
+
+    assert_equal_output(streamed_data, data)
+
+
+def test_bytes_equal_output():
+    fname = path.join(TEST_DIR, "files/cp2k_mulliken_uks_test01.out")
+
+    with io.open(fname, "r") as fobj:
+        data = parse_cp2k_output(fobj)
+
+    with io.open(fname, "rb") as fobj:
+        content = fobj.read()
+
+    # lines given as bytes without a file mode telling so
+    assert_equal_output(parse_cp2k_output(io.BytesIO(content)), data)
+    assert_equal_output(
+        parse_cp2k_output(line for line in content.splitlines(True)), data
+    )
+
+    assert parse_cp2k_output(io.BytesIO(b"")) == {"exceeded_walltime": False}
+
+
+def test_mmap_equal_output():
+    import mmap
+
+    for fname in ("cp2k_condnum_test01.out", "cp2k_mulliken_uks_test01.out"):
+        with io.open(path.join(TEST_DIR, "files", fname), "r") as fobj:
+            data = parse_cp2k_output(fobj)
+
+        with io.open(path.join(TEST_DIR, "files", fname), "rb") as fobj:
+            mapped = mmap.mmap(fobj.fileno(), 0, access=mmap.ACCESS_READ)
+            mapped_data = parse_cp2k_output(mapped)
+            mapped.close()
+
+        assert_equal_output(mapped_data, data)
+
+
+def test_all_steps():
+    with io.open(
+        path.join(TEST_DIR, "files/cp2k_mulliken_uks_test01.out"), "r"
+    ) as fobj:
+        content = fobj.read()
+
+    # emulate an output with three steps
+    data = parse_cp2k_output(io.StringIO(3 * content), all_steps=True)
+
+    arrays = data["step_arrays"]
+
+    assert np.allclose(arrays["energy"], 3 * [-247.133491957480686])
+    assert arrays["mulliken_charge"].shape == (3, 2)
+    assert np.allclose(arrays["mulliken_spin"], 3 * [[2.139166, 2.139164]])
+
+    # the dictionary still has the first Mulliken analysis only
+    assert len(data["mulliken_population_analysis"]["per-atom"]) == 2
+
+
+def test_bands():
+    from io import StringIO
+
+    output = StringIO(
+        u"""\
+ KPOINTS| Band Structure Calculation
+ KPOINTS| Special K-Point   1  GAMMA              0.0000    0.0000    0.0000
+ KPOINTS| Special K-Point   2  not specified      0.5000    0.0000    0.5000
+ Nr.   1    Spin 1    K-Point  0.00000000  0.00000000  0.00000000
+       5
+     -5.71237757      6.57185750      6.57185750      6.57185750
+      8.88653953
+ Nr.   1    Spin 2    K-Point  0.00000000  0.00000000  0.00000000
+       5
+     -5.71237758      6.57185751      6.57185751      6.57185751
+      8.88653954
+ Nr.   2    Spin 1    K-Point  0.50000000  0.00000000  0.50000000
+       5
+     -1.78530126     -1.78530126      2.59722480      2.59722480
+     12.60138650
+ Nr.   2    Spin 2    K-Point  0.50000000  0.00000000  0.50000000
+       5
+     -1.78530127     -1.78530127      2.59722481      2.59722481
+     12.60138651
+ The number of warnings for this run is : 0
+"""
+    )
+
+    data = parse_cp2k_output(output)
+
+    kpoint_data = data["kpoint_data"]
+
+    assert np.allclose(kpoint_data["kpoints"], [[0.0, 0.0, 0.0], [0.5, 0.0, 0.5]])
+    assert kpoint_data["labels"] == [(0, "GAMMA")]
+    assert kpoint_data["bands"].shape == (2, 2, 5)
+    assert np.allclose(
+        kpoint_data["bands"][0, 1],
+        [-1.78530126, -1.78530126, 2.5972248, 2.5972248, 12.6013865],
+    )
+    assert np.allclose(kpoint_data["bands"][1, 0, -1], 8.88653954)
+    assert data["nwarnings"] == 0
+
+
+def test_bands_truncated():
+    from io import StringIO
+
+    # the output of a killed run, ending within the bands of the second k-point
+    output = StringIO(
+        u"""\
+ KPOINTS| Band Structure Calculation
+ KPOINTS| Special K-Point   1  GAMMA              0.0000    0.0000    0.0000
+ KPOINTS| Special K-Point   2  X                  0.5000    0.0000    0.5000
+ Nr.   1    Spin 1    K-Point  0.00000000  0.00000000  0.00000000
+       5
+     -5.71237757      6.57185750      6.57185750      6.57185750
+      8.88653953
+ Nr.   1    Spin 2    K-Point  0.00000000  0.00000000  0.00000000
+       5
+     -5.71237758      6.57185751      6.57185751      6.57185751
+      8.88653954
+ Nr.   2    Spin 1    K-Point  0.50000000  0.00000000  0.50000000
+       5
+     -1.78530126     -1.78530126      2.59722480      2.59722480
+     12.60138650
+ Nr.   2    Spin 2    K-Point  0.50000000  0.00000000  0.50000000
+       5
+     -1.78530127     -1.78530127      2.59722481      2.59722481
+"""
+    )
+
+    kpoint_data = parse_cp2k_output(output)["kpoint_data"]
+
+    # only the k-point with the complete bands of both spins is kept
+    assert np.allclose(kpoint_data["kpoints"], [[0.0, 0.0, 0.0]])
+    assert kpoint_data["labels"] == [(0, "GAMMA")]
+    assert kpoint_data["bands"].shape == (2, 1, 5)
+
+
+RESTART_FILE_CONTENT = u"""\
+ &GLOBAL
+   PROJECT_NAME aiida
+   RUN_TYPE  MD
+ &END GLOBAL
+ &FORCE_EVAL
+   METHOD  FIST
+   &MM
+     &FORCEFIELD
+       &CHARGE
+         ATOM  O
+         CHARGE    -8.4760000000000002E-01
+       &END CHARGE
+       &CHARGE
+         ATOM  H1
+         CHARGE     4.2380000000000001E-01
+       &END CHARGE
+     &END FORCEFIELD
+   &END MM
+   &SUBSYS
+     &CELL
+       A     5.0000000000000000E+00    0.0000000000000000E+00    0.0000000000000000E+00
+       B     0.0000000000000000E+00    6.0000000000000000E+00    0.0000000000000000E+00
+       C     0.0000000000000000E+00    0.0000000000000000E+00    7.0000000000000000E+00
+       PERIODIC  XYZ
+       &CELL_REF
+         A     1.0000000000000000E+01    0.0000000000000000E+00    0.0000000000000000E+00
+         B     0.0000000000000000E+00    1.0000000000000000E+01    0.0000000000000000E+00
+         C     0.0000000000000000E+00    0.0000000000000000E+00    1.0000000000000000E+01
+       &END CELL_REF
+     &END CELL
+     &COORD
+O    2.0000000000000000E+00    2.7630000000000002E+00    2.5965000000000003E+00       H2O 1
+H1   2.0000000000000000E+00    3.5300000000000002E+00    2.0000000000000000E+00       H2O 1
+H1   2.0000000000000000E+00    2.0000000000000000E+00    2.0000000000000000E+00       H2O 1
+     &END COORD
+     &VELOCITY
+          1.0000000000000000E-04    2.0000000000000000E-04    3.0000000000000000E-04
+         -1.0000000000000000E-04   -2.0000000000000000E-04   -3.0000000000000000E-04
+          0.0000000000000000E+00    0.0000000000000000E+00    0.0000000000000000E+00
+     &END VELOCITY
+     &KIND O
+       ELEMENT  O
+     &END KIND
+     &KIND H1
+       ELEMENT  H
+     &END KIND
+   &END SUBSYS
+ &END FORCE_EVAL
+"""
+
+
+def test_restart_structure():
+    from io import StringIO
+
+    from aiida_cp2k.utils import parse_cp2k_trajectory
+
+    data = parse_cp2k_trajectory(StringIO(RESTART_FILE_CONTENT))
+
+    assert data["symbols"] == ["O", "H1", "H1"]
+    assert data["positions"].shape == (3, 3)
+    assert np.allclose(data["positions"][1], [2.0, 3.53, 2.0])
+    # the reference cell must not be picked up
+    assert np.allclose(data["cell"], np.diag([5.0, 6.0, 7.0]))
+    assert np.allclose(data["velocities"][1], [-1e-4, -2e-4, -3e-4])
+    assert data["kinds"] == {"O": "O", "H1": "H"}
+    assert np.isclose(data["charges"]["H1"], 0.4238)
+
+
+def test_xyz_trajectory():
+    from aiida_cp2k.utils import parse_cp2k_xyz_trajectory
+
+    frames = []
+    for step in range(5):
+        frames.append(
+            u"       2\n i =        {step}, time =        {time:.3f}, E =      -17.{step}\n".format(
+                step=step, time=0.5 * step
+            )
+        )
+        frames.append(u" O   {:.10f}   0.0000000000   1.0000000000\n".format(step))
+        frames.append(u" H   {:.10f}   0.5000000000   1.0000000000\n".format(step))
+
+    with io.BytesIO(u"".join(frames).encode("utf-8")) as fobj:
+        data = parse_cp2k_xyz_trajectory(fobj, stride=2)
+
+    assert data["symbols"] == ["O", "H"]
+    assert data["values"].shape == (3, 2, 3)
+    assert np.allclose(data["values"][:, 1, 0], [0.0, 2.0, 4.0])
+    assert list(data["steps"]) == [0, 2, 4]
+    assert np.allclose(data["times"], [0.0, 1.0, 2.0])
+    assert np.allclose(data["energies"], [-17.0, -17.2, -17.4])
+
+
+def test_xyz_trajectory_blocks(monkeypatch):
+    import aiida_cp2k.utils
+    from aiida_cp2k.utils import parse_cp2k_xyz_trajectory
+
+    frames = []
+    for step in range(7):
+        frames.append(u"       1\n i =        {}, E =      -1.0\n".format(step))
+        frames.append(u" Ar   {:.1f}   0.0   0.0\n".format(step))
+
+    # a frame cut off by a killed run
+    content = (u"".join(frames) + u"       1\n i = 7\n Ar   7.0").encode("utf-8")
+
+    # the frames are converted in blocks, not all at once
+    monkeypatch.setattr(aiida_cp2k.utils, "XYZ_BLOCK_FRAMES", 2)
+
+    with io.BytesIO(content) as fobj:
+        data = parse_cp2k_xyz_trajectory(fobj, stride=2)
+
+    assert data["symbols"] == ["Ar"]
+    assert data["values"].shape == (4, 1, 3)
+    assert np.allclose(data["values"][:, 0, 0], [0.0, 2.0, 4.0, 6.0])
+    assert list(data["steps"]) == [0, 2, 4, 6]
+    assert np.isnan(data["times"]).all()
+
+
+def test_xyz_trajectory_empty():
+    from aiida_cp2k.utils import parse_cp2k_xyz_trajectory
+
+    with io.BytesIO(b"") as fobj:
+        data = parse_cp2k_xyz_trajectory(fobj)
+
+    assert data["symbols"] == []
+    assert len(data["values"]) == len(data["steps"]) == 0
+
+
+def test_dcd_trajectory():
+    import struct
+
+    from aiida_cp2k.utils import parse_dcd_trajectory
+
+    positions = np.arange(4 * 3 * 3, dtype=np.float32).reshape(4, 3, 3)
+
+    def record(data):
+        return struct.pack("<i", len(data)) + data + struct.pack("<i", len(data))
+
+    # CHARMM DCD as written by CP2K, with a unit cell record for every frame
+    content = record(b"CORD" + struct.pack("<20i", *([0] * 10 + [1] + [0] * 8 + [24])))
+    content += record(struct.pack("<i", 1) + b"CP2K".ljust(80))
+    content += record(struct.pack("<i", 3))
+    for frame in positions:
+        content += record(struct.pack("<6d", 5.0, 90.0, 6.0, 90.0, 90.0, 7.0))
+        for axis in range(3):
+            content += record(frame[:, axis].tobytes())
+
+    # the frames are mapped, hence a real file is needed
+    with tempfile.TemporaryFile() as fobj:
+        fobj.write(content)
+        fobj.seek(0)
+        data = parse_dcd_trajectory(fobj, stride=3)
+
+    assert np.allclose(data["positions"], positions[::3])
+    assert np.allclose(data["cells"], [np.diag([5.0, 6.0, 7.0])] * 2)
+
+
+def test_disk_cache():
+    import shutil
+
+    from aiida_cp2k.utils import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, max_size=250)
+        cache.put("aaaa", b"a" * 100)
+        cache.put("bbbb", b"b" * 100)
+
+        # make "aaaa" the most recently used entry
+        os.utime(os.path.join(directory, "bb", "bbbb"), (0, 0))
+        assert cache.get("aaaa") == b"a" * 100
+
+        cache.put("cccc", b"c" * 100)
+
+        assert cache.get("bbbb") is None
+        assert cache.get("aaaa") == b"a" * 100
+        assert cache.get("cccc") == b"c" * 100
+
+        # the temporary file of an entry being written by another process is kept
+        tmp_path = os.path.join(directory, "aa", DiskCache.TMP_PREFIX + "aaaa")
+        with io.open(tmp_path, mode="wb") as fhandle:
+            fhandle.write(b"x" * 1000)
+        cache.evict()
+        assert os.path.exists(tmp_path)
+        assert cache.get("aaaa") == b"a" * 100
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_disk_cache_eviction_interval():
+    import shutil
+
+    from aiida_cp2k.utils import DiskCache
+
+    class CountingDiskCache(DiskCache):
+        evictions = 0
+
+        def evict(self):
+            CountingDiskCache.evictions += 1
+            super(CountingDiskCache, self).evict()
+
+    import random
+
+    random.seed(0)
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = CountingDiskCache(directory, max_size=100000)
+        for idx in range(1000):
+            cache.put("{:04d}".format(idx), b"a" * 100)
+
+        # the cache is scanned about every 10000 bytes, not on every put
+        assert 0 < CountingDiskCache.evictions < 100
+    finally:
+        shutil.rmtree(directory)
+
+
+_PARSED_FILES = []
+
+
+def _count_lines(fname):
+    _PARSED_FILES.append(fname)
+    with io.open(fname, mode="rb") as fobj:
+        return len(fobj.readlines())
+
+
+def test_parse_tasks_cache():
+    import shutil
+
+    pytest.importorskip("aiida")
+
+    from aiida_cp2k.parsers import _run_tasks, _task_key
+    from aiida_cp2k.utils import DiskCache
+
+    directory = tempfile.mkdtemp()
+    try:
+        cache = DiskCache(directory, max_size=1024 * 1024)
+        fname = os.path.join(directory, "aiida.out")
+        with io.open(fname, mode="wb") as fobj:
+            fobj.write(b"a\nb\n")
+
+        del _PARSED_FILES[:]
+        tasks = {"stdout": (_count_lines, (fname,))}
+
+        assert _run_tasks(tasks, 1, cache) == {"stdout": 2}
+        assert _run_tasks(tasks, 1, cache) == {"stdout": 2}
+        assert len(_PARSED_FILES) == 1  # the second result is taken from the cache
+
+        # the key depends on the content of the file
+        with io.open(fname, mode="wb") as fobj:
+            fobj.write(b"a\nb\nc\n")
+
+        assert _run_tasks(tasks, 1, cache) == {"stdout": 3}
+        assert len(_PARSED_FILES) == 2
+
+        # a corrupt entry is parsed again and replaced
+        key = _task_key(_count_lines, (fname,))
+        cache.put(key, b"corrupt")
+
+        assert _run_tasks(tasks, 1, cache) == {"stdout": 3}
+        assert len(_PARSED_FILES) == 3
+        assert _run_tasks(tasks, 1, cache) == {"stdout": 3}
+        assert len(_PARSED_FILES) == 3
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_parse_tasks_pool(monkeypatch):
+    import concurrent.futures
+    import shutil
+
+    pytest.importorskip("aiida")
+
+    import aiida_cp2k.parsers
+    from aiida_cp2k.parsers import _run_tasks
+
+    pools = []
+
+    class Future(object):
+        def __init__(self, result):
+            self._result = result
+
+        def result(self):
+            return self._result
+
+    class Executor(object):
+        """Runs the tasks in the calling process, recording the pools created"""
+
+        def __init__(self, max_workers):
+            pools.append(max_workers)
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *args):
+            pass
+
+        def submit(self, func, *args):
+            return Future(func(*args))
+
+    monkeypatch.setattr(concurrent.futures, "ProcessPoolExecutor", Executor)
+
+    directory = tempfile.mkdtemp()
+    try:
+        tasks = {}
+        for name in ("stdout", "restart", "positions"):
+            fname = os.path.join(directory, name)
+            with io.open(fname, mode="wb") as fobj:
+                fobj.write(b"a\nb\n")
+            tasks[name] = (_count_lines, (fname,))
+
+        # small files are parsed one after the other
+        assert _run_tasks(tasks, 4) == {"stdout": 2, "restart": 2, "positions": 2}
+        assert not pools
+
+        monkeypatch.setattr(aiida_cp2k.parsers, "POOL_MIN_SIZE", 12)
+        assert _run_tasks(tasks, 4) == {"stdout": 2, "restart": 2, "positions": 2}
+        assert pools == [3]
+    finally:
+        shutil.rmtree(directory)
+
+
+def test_total_time():
+    with io.open(path.join(TEST_DIR, "files/cp2k_condnum_test01.out"), "r") as fobj:
+        data = parse_cp2k_output(fobj)
+
+    # the maximum of the total time of the CP2K row in the timing report
+    assert data["total_time"] == 585.318
+
+
+def test_timings():
+    with io.open(
+        path.join(TEST_DIR, "files/cp2k_mulliken_uks_test01.out"), "r"
+    ) as fobj:
+        data = parse_cp2k_output(fobj)
+
+    timings = data["timings"]
+
+    assert len(timings["subroutines"]) == 21
+    assert timings["subroutines"][0] == "CP2K"
+    assert timings["total_time_maximum"][0] == data["total_time"] == 41896.06
+
+    # mp_alltoall_d11v: the number of calls does not fit into the column
+    idx = list(timings["subroutines"]).index("mp_alltoall_d11v")
+    assert np.isnan(timings["calls"][idx])
+    assert timings["asd"][idx] == 9.4
+    assert timings["self_time_average"][idx] == 7902.86
+    assert timings["self_time_maximum"][idx] == 8057.85
+
+
+def test_tabulate_output_parameters():
+    from aiida_cp2k.utils import tabulate_output_parameters
+
+    with io.open(path.join(TEST_DIR, "files/cp2k_condnum_test01.out"), "r") as fobj:
+        data = parse_cp2k_output(fobj)
+
+    table = tabulate_output_parameters(
+        {"b": data, "a": {"energy": -1.0, "exceeded_walltime": True}}
+    )
+
+    assert list(table["labels"]) == ["a", "b"]
+    np.testing.assert_allclose(table["energy"], [-1.0, data["energy"]])
+    np.testing.assert_allclose(table["exceeded_walltime"], [1.0, 0.0])
+    assert np.isnan(table["nwarnings"][0])
+    assert table["nwarnings"][1] == data["nwarnings"]
+
+    # only scalars are tabulated
+    assert "overlap_matrix_condition_number" not in table
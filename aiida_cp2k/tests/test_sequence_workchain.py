@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+###############################################################################
+# Copyright (c), The AiiDA-CP2K authors.                                      #
+# SPDX-License-Identifier: MIT                                                #
+# AiiDA-CP2K is hosted on GitHub at https://github.com/aiidateam/aiida-cp2k   #
+# For further information on the license, see the LICENSE.txt file.           #
+###############################################################################
+"""Test the wavefunction reuse along a sequence of structures"""
+
+from __future__ import print_function
+from __future__ import absolute_import
+
+import pytest
+
+from . import get_computer, get_code
+
+
+@pytest.mark.process_execution
+def test_cp2k_sequence_workchain(new_workdir):
+    """Testing the Cp2kSequenceWorkChain on stretched H2O molecules in two chains"""
+
+    import ase.build
+
+    from aiida.engine import run_get_node
+    from aiida.plugins import WorkflowFactory
+    from aiida.orm import Dict, Int, StructureData
+
+    computer = get_computer(workdir=new_workdir)
+    code = get_code(entry_point="cp2k", computer=computer)
+
+    # structures
+    structures = {}
+    for idx in range(4):
+        atoms = ase.build.molecule("H2O")
+        atoms.positions *= 1.0 + 0.01 * idx
+        atoms.center(vacuum=2.0)
+        structures["strain_{}".format(idx)] = StructureData(ase=atoms)
+
+    # parameters
+    parameters = Dict(
+        dict={
+            "FORCE_EVAL": {
+                "METHOD": "Quickstep",
+                "DFT": {
+                    "BASIS_SET_FILE_NAME": "BASIS_MOLOPT",
+                    "QS": {
+                        "EPS_DEFAULT": 1.0e-12,
+                        "WF_INTERPOLATION": "ps",
+                        "EXTRAPOLATION_ORDER": 3,
+                    },
+                    "MGRID": {"NGRIDS": 4, "CUTOFF": 280, "REL_CUTOFF": 30},
+                    "XC": {"XC_FUNCTIONAL": {"_": "LDA"}},
+                    "POISSON": {"PERIODIC": "none", "PSOLVER": "MT"},
+                },
+                "SUBSYS": {
+                    "KIND": [
+                        {
+                            "_": "O",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q6",
+                        },
+                        {
+                            "_": "H",
+                            "BASIS_SET": "DZVP-MOLOPT-SR-GTH",
+                            "POTENTIAL": "GTH-LDA-q1",
+                        },
+                    ]
+                },
+            }
+        }
+    )
+
+    options = {
+        "resources": {"num_machines": 1, "num_mpiprocs_per_machine": 1},
+        "max_wallclock_seconds": 1 * 3 * 60,
+    }
+
+    inputs = {
+        "cp2k": {
+            "parameters": parameters,
+            "code": code,
+            "metadata": {"options": options},
+        },
+        "structures": structures,
+        "num_chains": Int(2),
+    }
+
+    result, node = run_get_node(WorkflowFactory("cp2k.sequence"), **inputs)
+
+    assert node.is_finished_ok
+    assert sorted(result["output_parameters"]) == sorted(structures)
+
+    # the second structure of each chain starts from the wavefunction of the first
+    restarted = [c for c in node.called if "parent_calc_folder" in c.inputs]
+    assert len(restarted) == 2
+
+    for calc in restarted:
+        params = calc.inputs.parameters.get_dict()
+        assert params["FORCE_EVAL"]["DFT"]["SCF"]["SCF_GUESS"] == "RESTART"
+
+
+def test_natural_key():
+    """Testing that the structure labels are ordered by the value of their numbers"""
+
+    pytest.importorskip("aiida")
+
+    from aiida_cp2k.workflows import _natural_key
+
+    labels = ["img_10", "img_2", "img_1", "img_9", "a", "img_02b"]
+    assert sorted(labels, key=_natural_key) == [
+        "a",
+        "img_1",
+        "img_2",
+        "img_02b",
+        "img_9",
+        "img_10",
+    ]
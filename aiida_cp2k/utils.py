@@ -10,31 +10,40 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from itertools import chain
 from copy import deepcopy
+from itertools import chain, islice
+from collections import deque, namedtuple
+import io
 import math
+import mmap
+import os
+import random
+import tempfile
 
 import six
 import regex as re
 
 if six.PY2:
-    from collections import Mapping, MutableSequence
+    from collections import Mapping, MutableSequence, Sequence
 else:
-    from collections.abc import Mapping, MutableSequence
+    from collections.abc import Mapping, MutableSequence, Sequence
 
 
 class Cp2kInput:
     """Transforms dictionary into CP2K input"""
 
     DISCLAIMER = "!!! Generated by AiiDA !!!"
+    WRITE_CHUNK_SIZE = 4096  # lines
 
     def __init__(self, params=None):
+        # the passed-in dictionary is not copied but never changed: containers along
+        # the path of a new keyword are copied on write, the copies are kept here by id
+        self._owned = {}
+
         if not params:
-            self._params = {}
+            self._params = self._own({})
         else:
-            # always make a full copy to avoid that add_keyword() changes the
-            # passed-in dictionary
-            self._params = deepcopy(params)
+            self._params = params
 
     def add_keyword(self, kwpath, value):
         """
@@ -49,26 +58,60 @@ class Cp2kInput:
         if isinstance(kwpath, six.string_types):
             kwpath = kwpath.split("/")
 
-        Cp2kInput._add_keyword(kwpath, value, self._params)
+        self._params = self._own(self._params)
+        self._add_keyword(kwpath, value, self._params)
+
+    def add_keyword_to_sections(self, name, keyword, value):
+        """
+        Add a value for the given keyword to all sections with the given name.
+
+        Args:
+            name: the name of the sections (for example `DFT`), wherever they occur in the input
+            keyword: the keyword within the sections
+            value: the value to set the given key to
+        """
+
+        self._params = self._add_keyword_to_sections(
+            self._params, name.upper(), keyword, value
+        )
 
     @property
     def params(self):
         """get a copy of the internal nested dictionary"""
         return deepcopy(self._params)
 
-    def param_iter(self, keywords=True, sections=True):
-        """Iterator yielding ((section,section,...,section/keyword), value) tuples"""
-        stack = [((k,), v) for k, v in self._params.items()]
+    def param_iter(self, keywords=True, sections=True, section_names=None):
+        """
+        Iterator yielding ((section,section,...,section/keyword), value) tuples
+
+        The input is traversed breadth-first, the sections are yielded as read-only views.
+        If `section_names` is given, only the sections with one of these names are yielded.
+        Without keywords, only the sections are traversed.
+        """
+
+        if section_names is not None:
+            section_names = set(name.upper() for name in section_names)
 
-        while stack:
-            key, value = stack.pop(0)
+        queue = deque(((k,), v) for k, v in self._params.items())
+
+        while queue:
+            key, value = queue.popleft()
             if isinstance(value, Mapping):
-                if sections:
-                    yield (key, value)
-                stack += [(key + (k,), v) for k, v in value.items()]
+                if sections and (
+                    section_names is None or key[-1].upper() in section_names
+                ):
+                    yield (key, _ReadOnlyMapping(value))
+                queue.extend(
+                    (key + (k,), v)
+                    for k, v in value.items()
+                    if keywords or isinstance(v, (Mapping, MutableSequence))
+                )
             elif isinstance(value, MutableSequence):
-                for entry in value:
-                    stack += [(key, entry)]
+                queue.extend(
+                    (key, entry)
+                    for entry in value
+                    if keywords or isinstance(entry, Mapping)
+                )
             else:
                 yield (key, value)
 
@@ -76,31 +119,93 @@ class Cp2kInput:
         """Return the CP2K input file structure as a string"""
         output = [self.DISCLAIMER]
         self._render_section(output, self._params)
-        return "\n".join(
-            chain([self.DISCLAIMER], Cp2kInput._render_section(self._params))
-        )
+        return "\n".join(output)
 
     def to_file(self, fhandle):
         """Write the CP2K input file structure to the given file descriptor"""
-        fhandle.write(u"{self.DISCLAIMER}".format(self=self))
-        for line in Cp2kInput._render_section(self._params):
-            fhandle.write(u"\n{line}".format(line=line))
+        output = [self.DISCLAIMER]
+        self._render_section(output, self._params)
 
-    @staticmethod
-    def _add_keyword(kwpath, value, params):
-        """Add keyword in given nested dictionary"""
+        # the whole input is rendered before writing, hence invalid keys are detected
+        # before anything is written, then it is written in chunks of lines
+        fhandle.write(u"{}".format(output[0]))
+        for start in range(1, len(output), self.WRITE_CHUNK_SIZE):
+            fhandle.write(
+                u"\n" + u"\n".join(output[start : start + self.WRITE_CHUNK_SIZE])
+            )
+
+    def _own(self, container):
+        """Return the container if owned by this instance, otherwise an owned shallow copy"""
+
+        if id(container) in self._owned:
+            return container
+
+        if isinstance(container, Mapping):
+            container = dict(container)
+        else:
+            container = list(container)
+
+        self._owned[id(container)] = container
+        return container
+
+    def _add_keyword(self, kwpath, value, params):
+        """Add keyword in given nested dictionary, which must be owned by this instance"""
 
         if len(kwpath) == 1:  # key/value for the current level
             params[kwpath[0]] = value
             return
 
         if kwpath[0] not in params.keys():  # create an empty section if necessary
-            params[kwpath[0]] = {}
+            params[kwpath[0]] = self._own({})
+        else:
+            params[kwpath[0]] = self._own(params[kwpath[0]])
+
+        self._add_keyword(kwpath[1:], value, params[kwpath[0]])
+
+    def _add_keyword_to_sections(self, params, name, keyword, value):
+        """
+        Add keyword to all sections with the given name in the nested dictionary,
+        return the dictionary itself or an owned copy if anything had to be changed.
+        """
+
+        for key, val in params.items():
+            if isinstance(val, Mapping):
+                entries = [val]
+            elif isinstance(val, MutableSequence):
+                entries = val
+            else:
+                continue
+
+            new_entries = None  # only copied once an entry has been changed
+            for idx, entry in enumerate(entries):
+                if not isinstance(entry, Mapping):
+                    continue
+
+                new_entry = self._add_keyword_to_sections(entry, name, keyword, value)
+
+                if key.upper() == name:
+                    new_entry = self._own(new_entry)
+                    new_entry[keyword] = value
 
-        Cp2kInput._add_keyword(kwpath[1:], value, params[kwpath[0]])
+                if new_entry is not entry:
+                    if new_entries is None:
+                        new_entries = list(entries)
+                    new_entries[idx] = new_entry
+
+            if new_entries is None:
+                continue
+
+            params = self._own(params)
+            if isinstance(val, Mapping):
+                params[key] = new_entries[0]
+            else:
+                self._owned[id(new_entries)] = new_entries
+                params[key] = new_entries
+
+        return params
 
     @staticmethod
-    def _render_section(params, indent=0, indent_width=3):
+    def _render_section(output, params, indent=0, indent_width=3, names=None):
         """
         It takes a dictionary and recurses through.
 
@@ -130,60 +235,602 @@ class Cp2kInput:
                   &KIND O
                      ELEMENT  O
                   &END KIND
+
+        The lines are appended to the `output` list, `names` caches the validated
+        keys with the section prefix stripped, to check every distinct key only once.
         """
 
+        if names is None:
+            names = {}
+
+        ispace = " " * indent
+
         for key, val in sorted(params.items()):
             # the `_` is reserved for section params and evaluated in the prior call
             if key == "_":
                 continue
 
-            # keys are not case-insensitive, ensure that they follow the current scheme
-            if key.upper() != key:
-                raise ValueError("keyword '{key}' not upper case".format(key=key))
+            kind = _VALUE_KINDS.get(type(val)) or _value_kind(val)
+            is_section = kind in (_SECTION, _REPETITION)
 
-            if key.startswith(("@", "$")):
-                raise ValueError("CP2K preprocessor directives not supported")
+            try:
+                name = names[key, is_section]
+            except KeyError:
+                name = names[key, is_section] = Cp2kInput._validated_key(
+                    key, is_section
+                )
 
-            if key.startswith("&"):
-                # we have to allow an explicit section prefix to be able to distinguish
-                # between sections and keywords with the same name which can occur in CP2K input
-                if isinstance(val, (Mapping, MutableSequence)):
-                    # simply strip the section prefix if present
-                    key = key.strip("&")
-                else:
-                    raise ValueError(
-                        "invalid section prefix '&' encountered in bare keyword '{key}'".format(
-                            key=key
-                        )
-                    )
+            if kind is _SECTION:
+                Cp2kInput._render_subsection(
+                    output, name, val, indent, indent_width, names
+                )
 
-            ispace = " " * indent
+            elif kind is _REPETITION:
+                Cp2kInput._render_list(output, name, val, indent, indent_width, names)
 
-            if isinstance(val, Mapping):
-                line = "{ispace}&{key}".format(ispace=ispace, key=key)
-                if "_" in val:  # if there is a section parameter, add it
-                    line += " {}".format(val["_"])
+            elif kind is _ARRAY:
+                lines = _format_array(ispace + name + " ", val)
+                if lines:
+                    output.append(lines)
 
-                yield line
-                # once we are on Python3-only, replace the following with a `yield from ...`
-                for item in Cp2kInput._render_section(val, indent + indent_width):
-                    yield item
-                yield "{ispace}&END {key}".format(ispace=ispace, key=key)
+            else:
+                output.append(ispace + name + " " + _format_value(val, kind))
 
-            elif isinstance(val, MutableSequence):
-                for listitem in val:
-                    # once we are on Python3-only, replace the following with a `yield from ...`
-                    for line in Cp2kInput._render_section({key: listitem}, indent):
-                        yield line
-
-            elif isinstance(val, bool):
-                val_str = ".TRUE." if val else ".FALSE."
-                yield "{ispace}{key} {val_str}".format(
-                    ispace=ispace, key=key, val_str=val_str
+    @staticmethod
+    def _validated_key(key, is_section):
+        """Return the key with section prefixes stripped, raise ValueError if invalid"""
+
+        # keys are not case-insensitive, ensure that they follow the current scheme
+        if key.upper() != key:
+            raise ValueError("keyword '{key}' not upper case".format(key=key))
+
+        if key.startswith(("@", "$")):
+            raise ValueError("CP2K preprocessor directives not supported")
+
+        if key.startswith("&"):
+            # we have to allow an explicit section prefix to be able to distinguish
+            # between sections and keywords with the same name which can occur in CP2K input
+            if is_section:
+                # simply strip the section prefix if present
+                return key.strip("&")
+
+            raise ValueError(
+                "invalid section prefix '&' encountered in bare keyword '{key}'".format(
+                    key=key
                 )
+            )
+
+        return key
 
+    @staticmethod
+    def _render_subsection(output, name, section, indent, indent_width, names):
+        ispace = " " * indent
+
+        line = ispace + "&" + name
+        if "_" in section:  # if there is a section parameter, add it
+            line += " {}".format(section["_"])
+
+        output.append(line)
+        Cp2kInput._render_section(
+            output, section, indent + indent_width, indent_width, names
+        )
+        output.append(ispace + "&END " + name)
+
+    @staticmethod
+    def _render_list(output, name, entries, indent, indent_width, names):
+        """Render the repetitions of a section or keyword, without re-validating the key"""
+
+        prefix = " " * indent + name + " "
+
+        for entry in entries:
+            kind = _VALUE_KINDS.get(type(entry)) or _value_kind(entry)
+
+            if kind is _SECTION:
+                Cp2kInput._render_subsection(
+                    output, name, entry, indent, indent_width, names
+                )
+            elif kind is _REPETITION:
+                Cp2kInput._render_list(output, name, entry, indent, indent_width, names)
+            elif kind is _ARRAY:
+                lines = _format_array(prefix, entry)
+                if lines:
+                    output.append(lines)
             else:
-                yield "{ispace}{key} {val}".format(ispace=ispace, key=key, val=val)
+                output.append(prefix + _format_value(entry, kind))
+
+
+_SECTION, _REPETITION, _ARRAY, _BOOL, _STRING, _VALUE = (
+    "section",
+    "repetition",
+    "array",
+    "bool",
+    "str",
+    "value",
+)
+
+# the kind of value for the types in the input, checking the ABCs is comparatively slow
+_VALUE_KINDS = {dict: _SECTION, list: _REPETITION, bool: _BOOL, str: _STRING}
+
+
+def _value_kind(value):
+    """Return the kind of the value for the CP2K input, cached by type"""
+
+    import numpy as np
+
+    if isinstance(value, Mapping):
+        kind = _SECTION
+    elif isinstance(value, MutableSequence):
+        kind = _REPETITION
+    elif isinstance(value, np.ndarray):
+        kind = _ARRAY
+    elif isinstance(value, bool):
+        kind = _BOOL
+    else:
+        kind = _VALUE
+
+    _VALUE_KINDS[type(value)] = kind
+    return kind
+
+
+def _format_value(value, kind):
+    if kind is _STRING:
+        return value
+
+    if kind is _BOOL:
+        return ".TRUE." if value else ".FALSE."
+
+    return "{}".format(value)
+
+
+def _array_format(dtype):
+    """Return the %-format for the values of the given (non-structured) dtype"""
+
+    if dtype.kind == "f":
+        return "%r"  # the shortest representation of the (double) value
+
+    if dtype.kind in "iu":
+        return "%d"
+
+    return "%s"
+
+
+def _format_array(prefix, array):
+    """
+    Return the lines for a keyword with a NumPy array as value: a single line for a 1-D
+    array, one line per row for a 2-D or structured array (for example with the kinds and
+    coordinates of atoms). All values are formatted by a single %-format operation,
+    instead of formatting every value separately.
+    """
+
+    import numpy as np
+
+    if array.dtype.names:  # structured array, the fields are the columns
+        fields = [array[name].reshape(len(array), -1) for name in array.dtype.names]
+    else:
+        field = np.atleast_2d(array)
+        fields = [field.reshape(-1, field.shape[-1])]
+
+    # the logical values are converted into their CP2K representation
+    fields = [
+        np.where(field, ".TRUE.", ".FALSE.") if field.dtype.kind == "b" else field
+        for field in fields
+    ]
+
+    line = prefix + " ".join(
+        " ".join([_array_format(field.dtype)] * field.shape[1]) for field in fields
+    )
+
+    return _format_rows(line, fields)
+
+
+def _format_rows(line, fields):
+    """
+    Return the lines given by applying the %-format `line` to the rows of the fields
+    (2-D arrays with the same number of rows), formatting all values at once.
+    """
+
+    import numpy as np
+
+    if len(fields) == 1:
+        values = fields[0]
+    else:  # interleave the values of the fields, converted to Python objects
+        values = np.empty(
+            (len(fields[0]), sum(f.shape[1] for f in fields)), dtype=object
+        )
+        start = 0
+        for field in fields:
+            values[:, start : start + field.shape[1]] = field.astype(object)
+            start += field.shape[1]
+
+    return "\n".join([line] * len(values)) % tuple(values.ravel().tolist())
+
+
+def _read_only(value):
+    if isinstance(value, Mapping):
+        return _ReadOnlyMapping(value)
+    if isinstance(value, MutableSequence):
+        return _ReadOnlySequence(value)
+    return value
+
+
+class _ReadOnlyMapping(Mapping):
+    """Read-only view of a nested dictionary, comparing equal to the dictionary"""
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, key):
+        return _read_only(self._data[key])
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+class _ReadOnlySequence(Sequence):
+    """Read-only view of a list in a nested dictionary, comparing equal to the list"""
+
+    def __init__(self, data):
+        self._data = data
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [_read_only(v) for v in self._data[index]]
+        return _read_only(self._data[index])
+
+    def __len__(self):
+        return len(self._data)
+
+    def __eq__(self, other):
+        if isinstance(other, Sequence) and not isinstance(other, six.string_types):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return repr(self._data)
+
+
+# sections whose lines are data (for example atoms and coordinates) rather than
+# keywords, stored in order as list under the key " ", except for the given keywords
+CP2K_INPUT_DATA_SECTIONS = {
+    "COORD": ("UNIT", "SCALED"),
+    "CORE_COORD": ("UNIT", "SCALED"),
+    "SHELL_COORD": ("UNIT", "SCALED"),
+    "VELOCITY": ("PINT_UNIT",),
+    "CORE_VELOCITY": (),
+    "SHELL_VELOCITY": (),
+    "BASIS": (),
+    "POTENTIAL": (),
+}
+
+CP2K_INPUT_VARIABLE_MATCH = re.compile(
+    r"\$(?:\{(?P<braced>[A-Za-z_]\w*)(?:-(?P<default>[^}]*))?\}|(?P<name>[A-Za-z_]\w*))"
+)
+
+
+def parse_cp2k_input(fobj, basedir=".", variables=None):
+    """
+    CP2K input file parser, returning the nested dictionary as used by Cp2kInput.
+
+    The preprocessor directives @INCLUDE, @SET, @IF/@ENDIF and variables ($VAR, ${VAR}
+    and ${VAR-default}) are expanded, included files are looked up relative to `basedir`.
+    Keywords and section names are converted to upper case, the values of keywords are
+    kept as strings (or True for a keyword given without value). Repeated keywords and
+    sections are returned as lists, section parameters as key `_`, and a section with
+    the same name as a keyword of the same section with a `&` prefix.
+    """
+
+    root = {}
+    sections = [(None, root)]  # the currently open sections: (name, content)
+
+    variables = {k.upper(): v for k, v in (variables or {}).items()}
+
+    for line in _preprocess_cp2k_input(fobj, basedir, variables):
+        name, value = _split_input_line(line)
+        name = name.upper()
+
+        if name == "&END":
+            if len(sections) == 1:
+                raise ValueError("unexpected '{}' outside of any section".format(line))
+
+            section_name, _ = sections.pop()
+            if value and value.upper() != section_name:
+                raise ValueError(
+                    "'{}' does not match the open section '{}'".format(
+                        line, section_name
+                    )
+                )
+            continue
+
+        parent_name, parent = sections[-1]
+
+        if name.startswith("&"):
+            section = {"_": value} if value else {}
+            _insert_input_section(parent, name[1:], section)
+            sections.append((name[1:], section))
+
+        elif parent_name in CP2K_INPUT_DATA_SECTIONS and (
+            name not in CP2K_INPUT_DATA_SECTIONS[parent_name]
+        ):
+            parent.setdefault(" ", []).append(line)
+
+        else:
+            _insert_input_keyword(parent, name, value if value else True)
+
+    if len(sections) > 1:
+        raise ValueError("section '{}' is not closed".format(sections[-1][0]))
+
+    return root
+
+
+def _is_input_section(value):
+    if isinstance(value, list):
+        return isinstance(value[0], dict)
+    return isinstance(value, dict)
+
+
+def _insert_input_value(params, key, value):
+    if key not in params:
+        params[key] = value
+    elif isinstance(params[key], list):
+        params[key].append(value)
+    else:
+        params[key] = [params[key], value]
+
+
+def _insert_input_section(params, name, section):
+    # sections and keywords with the same name have to be distinguished by a `&` prefix
+    if name in params and not _is_input_section(params[name]):
+        name = "&" + name
+
+    _insert_input_value(params, name, section)
+
+
+def _insert_input_keyword(params, name, value):
+    if name in params and _is_input_section(params[name]):
+        params["&" + name] = params.pop(name)
+
+    _insert_input_value(params, name, value)
+
+
+def _preprocess_cp2k_input(fobj, basedir, variables):
+    """
+    Yield the stripped, non-empty lines of the CP2K input with comments removed and
+    preprocessor directives expanded. The `variables` are shared with included files.
+    """
+
+    conditions = []  # the values of the enclosing @IF directives
+
+    for line in _logical_input_lines(fobj):
+        directive = _split_input_line(line)[0].upper() if line[0] == "@" else None
+
+        # lines in a false @IF block are skipped, except for the nesting of blocks
+        if conditions and not all(conditions):
+            if directive == "@IF":
+                conditions.append(False)
+            elif directive == "@ENDIF":
+                conditions.pop()
+            continue
+
+        if "$" in line:
+            line = CP2K_INPUT_VARIABLE_MATCH.sub(
+                lambda match: _input_variable_value(match, variables), line
+            )
+
+        if directive is None:
+            yield line
+            continue
+
+        argument = _split_input_line(line)[1]
+
+        if directive == "@SET":
+            if not argument:
+                raise ValueError("@SET without variable name")
+            name, value = _split_input_line(argument)
+            variables[name.upper()] = value
+
+        elif directive == "@IF":
+            conditions.append(_input_condition(argument))
+
+        elif directive == "@ENDIF":
+            if not conditions:
+                raise ValueError("@ENDIF without @IF")
+            conditions.pop()
+
+        elif directive == "@INCLUDE":
+            fname = os.path.join(basedir, argument.strip("'\""))
+            with io.open(fname, mode="r", encoding="utf-8") as included:
+                # once we are on Python3-only, replace the following with a `yield from ...`
+                for included_line in _preprocess_cp2k_input(
+                    included, os.path.dirname(fname), variables
+                ):
+                    yield included_line
+
+        else:
+            raise ValueError(
+                "CP2K preprocessor directive '{}' not supported".format(directive)
+            )
+
+    if conditions:
+        raise ValueError("@IF without @ENDIF")
+
+
+def _logical_input_lines(fobj):
+    """Yield the stripped, non-empty lines without comments, joining continued lines"""
+
+    continued = ""
+
+    for line in fobj:
+        if "!" in line or "#" in line:
+            line = _strip_input_comment(line)
+
+        line = continued + line.strip()
+
+        if line.endswith("\\"):
+            continued = line[:-1] + " "
+            continue
+
+        continued = ""
+
+        if line:
+            yield line
+
+    if continued.strip():
+        yield continued.strip()
+
+
+def _split_input_line(line):
+    """Split a stripped line into the first word and the rest"""
+
+    parts = line.split(None, 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+def _strip_input_comment(line):
+    """Remove a comment starting with `!` or `#`, unless quoted"""
+
+    quote = None
+
+    for idx, char in enumerate(line):
+        if quote:
+            if char == quote:
+                quote = None
+        elif char in "'\"":
+            quote = char
+        elif char in "!#":
+            return line[:idx]
+
+    return line
+
+
+def _input_variable_value(match, variables):
+    name = (match.group("braced") or match.group("name")).upper()
+
+    if name in variables:
+        return variables[name]
+
+    if match.group("default") is not None:
+        return match.group("default")
+
+    raise ValueError("variable '{}' used but not defined".format(name))
+
+
+def _input_condition(expression):
+    """Evaluate the expression of an @IF: a comparison with == or /=, or a single value"""
+
+    for operator, result in (("==", True), ("/=", False)):
+        if operator in expression:
+            left, _, right = expression.partition(operator)
+            return (left.strip() == right.strip()) == result
+
+    return expression.strip() not in ("", "0")
+
+
+STRUCTURE_WRITE_CHUNK_SIZE = 65536  # atoms
+
+
+def write_structure(fhandle, sites, kinds, cell, fileformat="XYZ"):
+    """
+    Write the structure given by the `sites`, `kinds` and `cell` attributes of a
+    StructureData as coordinate file for CP2K in the given format (XYZ, CIF or PDB).
+
+    The kind names are used as atom names (to be matched with the KIND sections).
+    In the CIF file the coordinates are fractional and the cell is given by its lengths
+    and angles, hence the cell has to be read from it (CELL_FILE_FORMAT CIF) as well.
+    The PDB format has a fixed precision of 1e-3 Angstrom.
+    """
+
+    import numpy as np
+
+    positions = np.array([site["position"] for site in sites], dtype=np.float64)
+    positions = positions.reshape(-1, 3)
+    names = np.array([site["kind_name"] for site in sites]).reshape(-1, 1)
+
+    fileformat = fileformat.upper()
+
+    if fileformat == "XYZ":
+        fhandle.write(u"{}\n\n".format(len(sites)))
+        line, fields = "%s %r %r %r", [names, positions]
+
+    elif fileformat == "CIF":
+        cell = np.array(cell, dtype=np.float64)
+        lengths = np.linalg.norm(cell, axis=1)
+        angles = [
+            np.degrees(np.arccos(np.dot(cell[i], cell[j]) / (lengths[i] * lengths[j])))
+            for i, j in ((1, 2), (0, 2), (0, 1))
+        ]
+
+        symbols = {kind["name"]: "".join(kind["symbols"]) for kind in kinds}
+
+        fhandle.write(
+            u"""\
+data_aiida
+_symmetry_space_group_name_H-M 'P 1'
+_cell_length_a {!r}
+_cell_length_b {!r}
+_cell_length_c {!r}
+_cell_angle_alpha {!r}
+_cell_angle_beta {!r}
+_cell_angle_gamma {!r}
+loop_
+_symmetry_equiv_pos_as_xyz
+'x, y, z'
+loop_
+_atom_site_label
+_atom_site_type_symbol
+_atom_site_fract_x
+_atom_site_fract_y
+_atom_site_fract_z
+""".format(
+                *(lengths.tolist() + [float(a) for a in angles])
+            )
+        )
+        line = "%s %s %r %r %r"
+        fields = [
+            names,
+            np.vectorize(symbols.get, otypes=[object])(names),
+            np.linalg.solve(cell.T, positions.T).T,  # fractional coordinates
+        ]
+
+    elif fileformat == "PDB":
+        if any(len(kind["name"]) > 4 for kind in kinds):
+            raise ValueError("kind names are limited to 4 characters in PDB files")
+
+        symbols = {kind["name"]: "".join(kind["symbols"]) for kind in kinds}
+
+        # the atom serial numbers wrap around beyond the 5 columns of the field
+        serials = (np.arange(1, len(sites) + 1) % 100000).reshape(-1, 1)
+
+        line = "ATOM  %5d %-4s MOL A   1    %8.3f%8.3f%8.3f  1.00  0.00          %2s"
+        fields = [
+            serials,
+            names,
+            positions,
+            np.vectorize(symbols.get, otypes=[object])(names),
+        ]
+
+    else:
+        raise ValueError("unsupported structure file format '{}'".format(fileformat))
+
+    # the lines are formatted and written in chunks to limit the memory needed
+    for start in range(0, len(sites), STRUCTURE_WRITE_CHUNK_SIZE):
+        chunk = [field[start : start + STRUCTURE_WRITE_CHUNK_SIZE] for field in fields]
+        fhandle.write(six.text_type(_format_rows(line, chunk)))
+        fhandle.write(u"\n")
+
+    if fileformat == "PDB":
+        fhandle.write(u"END\n")
 
 
 CP2K_CONDITION_NUMBER_MATCH = re.compile(
@@ -264,174 +911,926 @@ CP2K_MULLIKEN_MATCH = re.compile(
 )
 
 
-def parse_cp2k_output(fobj):
-    content = fobj.read()
-    lines = content.splitlines()
+def parse_cp2k_output(fobj, all_steps=False):
+    """
+    Parse the CP2K standard output in a single pass over the lines of the given file object.
 
-    result_dict = {"exceeded_walltime": False}
+    Only the lines of the currently open block (condition numbers, Mulliken analysis)
+    are kept in memory, never the complete output.
+
+    The file object can also yield bytes (a file opened in binary mode, a BytesIO or any
+    iterable of bytes) or be a memory-mapped file, in which case the output is parsed on the
+    raw bytes and only the captured values are converted. For a mapped file the sections are
+    matched directly on the mapping.
+
+    With `all_steps` the energies and Mulliken analyses of all steps (MD, GEO_OPT, ...) are
+    returned in addition as NumPy arrays (steps, or steps x atoms) under `step_arrays`.
+
+    The timing report at the end of the run is returned as NumPy arrays, one entry per
+    subroutine, under `timings`, its first row (CP2K) gives the `total_time` in seconds.
+    """
 
-    for i_line, line in enumerate(lines):
-        if line.startswith(" ENERGY| "):
+    if isinstance(fobj, mmap.mmap):
+        content = fobj
+        lines = iter(fobj.readline, b"")
+        binary = True
+    else:
+        content = None
+        lines = iter(fobj)
+
+        # whether the lines are bytes is told by the first line, not by the file mode,
+        # which is not available for BytesIO objects or generators
+        first_line = next(lines, None)
+        binary = isinstance(first_line, bytes)
+        if first_line is not None:
+            lines = chain([first_line], lines)
+
+    lit = _BINARY_LITERALS if binary else _TEXT_LITERALS
+
+    result_dict = {"exceeded_walltime": False}
+    steps = {} if all_steps else None
+
+    bands = None
+    timing = None
+    sections = list(lit.sections)
+    section = None  # the section whose block is currently being read
+    block = None
+    offset = 0  # offset of the current line in the file
+
+    for line in lines:
+        line_offset = offset
+        offset += len(line)
+
+        if bands is not None and bands.in_block:
+            # the eigenvalue lines of the band structure can not contain anything else
+            bands.feed(line.decode("utf-8") if binary else line)
+            continue
+
+        if timing is not None and timing.in_table:
+            timing.feed(line.decode("utf-8") if binary else line)
+            continue
+
+        if block is not None:
+            block.append(line)
+
+            if section.block_end(block):
+                if _parse_section(
+                    section, lit.empty.join(block), 0, result_dict, steps
+                ) and not _parse_all_steps(section, steps):
+                    # only the first complete occurrence of a section is parsed
+                    sections.remove(section)
+                block = None
+
+        if line.startswith(lit.energy):
             result_dict["energy"] = float(line.split()[8])
             result_dict["energy_units"] = "a.u."
-        elif "The number of warnings for this run is" in line:
+            if steps is not None:
+                steps.setdefault("energy", []).append(result_dict["energy"])
+        elif lit.nwarnings in line:
             result_dict["nwarnings"] = int(line.split()[-1])
-        elif "exceeded requested execution time" in line:
+        elif lit.walltime in line:
             result_dict["exceeded_walltime"] = True
-        elif "KPOINTS| Band Structure Calculation" in line:
-            kpoints, labels, bands = _parse_bands(lines, i_line)
-            result_dict["kpoint_data"] = {
-                "kpoints": kpoints,
-                "labels": labels,
-                "bands": bands,
-                "bands_unit": "eV",
-            }
-        else:
-            # ignore all other lines
-            pass
+        elif lit.timing in line:
+            # a new timing report supersedes any previous one
+            timing = _TimingParser()
+        elif lit.bands in line:
+            # a new band structure section supersedes any previous one
+            bands = _BandsParser()
+        elif bands is not None:
+            bands.feed(line.decode("utf-8") if binary else line)
+
+        for candidate in sections:
+            if candidate.anchor in line:
+                if content is not None:
+                    # the pattern can read ahead in the mapping, no need to buffer the block
+                    if _parse_section(
+                        candidate, content, line_offset, result_dict, steps
+                    ) and not _parse_all_steps(candidate, steps):
+                        sections.remove(candidate)
+                else:
+                    section = candidate
+                    block = [line]
+                break
+
+    if block is not None:  # the output ended while reading a block
+        _parse_section(section, lit.empty.join(block), 0, result_dict, steps)
+
+    if bands is not None:
+        kpoints, labels, bands = bands.result()
+        result_dict["kpoint_data"] = {
+            "kpoints": kpoints,
+            "labels": labels,
+            "bands": bands,
+            "bands_unit": "eV",
+        }
 
-    match = CP2K_CONDITION_NUMBER_MATCH.search(content)
-    if match:
-        captures = match.groupdict()
+    if timing is not None:
+        result_dict["timings"] = timing.result()
 
-        result_dict["overlap_matrix_condition_number"] = {
-            "1-norm (estimate)": {
-                "|A|": float(captures["norm1_estimate_A"]),
-                "|A^-1|": float(captures["norm1_estimate_Ainv"]),
-                "CN": float(captures["norm1_estimate"]),
-                "Log(CN)": float(captures["norm1_estimate_log"]),
-            },
-            "1-norm (using diagonalization)": {
-                "|A|": float(captures["norm1_diag_A"]),
-                "|A^-1|": float(captures["norm1_diag_Ainv"]),
-                "CN": float(captures["norm1_diag"]),
-                "Log(CN)": float(captures["norm1_diag_log"]),
-            },
-            "2-norm (using diagonalization)": {
-                "max EV": float(captures["norm2_diag_max_ev"]),
-                "min EV": float(captures["norm2_diag_min_ev"]),
-                "CN": float(captures["norm2_diag"]),
-                "Log(CN)": float(captures["norm2_diag_log"]),
-            },
+        # the maximum over all MPI ranks of the total time of the run
+        total = result_dict["timings"]["subroutines"] == "CP2K"
+        if total.any():
+            result_dict["total_time"] = float(
+                result_dict["timings"]["total_time_maximum"][total][0]
+            )
+
+    if steps is not None:
+        import numpy as np
+
+        # the per-step arrays of the sections are stacked to (steps x atoms) arrays
+        result_dict["step_arrays"] = {
+            key: np.array(values, dtype=np.float64) for key, values in steps.items()
         }
 
-    match = CP2K_MULLIKEN_MATCH.search(content)
+    return result_dict
+
+
+def _parse_section(section, content, pos, result_dict, steps=None):
+    """
+    Match the section pattern at the position of its anchor and store the converted result.
+
+    The pattern is anchored at `pos` instead of searching through `content`.
+    Only the first occurrence of a section is stored in the result dictionary, while
+    the arrays of every occurrence are collected in `steps` if given.
+    Returns whether the section could be parsed.
+    """
+
+    match = section.pattern.match(content, pos)
+    if not match:
+        return False
+
+    if section.key not in result_dict:
+        result_dict[section.key] = section.convert(match)
+
+    if _parse_all_steps(section, steps):
+        for key, values in section.step_arrays(match).items():
+            steps.setdefault(key, []).append(values)
+
+    return True
+
+
+def _parse_all_steps(section, steps):
+    return steps is not None and section.step_arrays is not None
+
+
+def _to_text(value):
+    """Decode a value captured from the raw bytes of the output"""
+
+    if isinstance(value, six.binary_type):
+        return value.decode("utf-8")
+
+    return value
+
+
+def _condition_number_dict(match):
+    """Convert a match of CP2K_CONDITION_NUMBER_MATCH to the result dictionary"""
+
+    captures = match.groupdict()
+
+    return {
+        "1-norm (estimate)": {
+            "|A|": float(captures["norm1_estimate_A"]),
+            "|A^-1|": float(captures["norm1_estimate_Ainv"]),
+            "CN": float(captures["norm1_estimate"]),
+            "Log(CN)": float(captures["norm1_estimate_log"]),
+        },
+        "1-norm (using diagonalization)": {
+            "|A|": float(captures["norm1_diag_A"]),
+            "|A^-1|": float(captures["norm1_diag_Ainv"]),
+            "CN": float(captures["norm1_diag"]),
+            "Log(CN)": float(captures["norm1_diag_log"]),
+        },
+        "2-norm (using diagonalization)": {
+            "max EV": float(captures["norm2_diag_max_ev"]),
+            "min EV": float(captures["norm2_diag_min_ev"]),
+            "CN": float(captures["norm2_diag"]),
+            "Log(CN)": float(captures["norm2_diag_log"]),
+        },
+    }
+
+
+def _mulliken_dict(match):
+    """Convert a match of CP2K_MULLIKEN_MATCH to the result dictionary"""
+
     # for this one we needed the extended regex library https://pypi.python.org/pypi/regex
-    if match:
-        captures = match.capturesdict()
-        per_atom = []
-
-        if captures.get("population_alpha"):
-            for idx in range(len(captures["atom"])):
-                per_atom.append(
-                    {
-                        "element": captures["element"][idx],
-                        "kind": int(captures["kind"][idx]),
-                        "population_alpha": float(captures["population_alpha"][idx]),
-                        "population_beta": float(captures["population_beta"][idx]),
-                        "charge": float(captures["charge"][idx]),
-                        "spin": float(captures["spin"][idx]),
-                    }
-                )
+    captures = match.capturesdict()
+    per_atom = []
+
+    if captures.get("population_alpha"):
+        for idx in range(len(captures["atom"])):
+            per_atom.append(
+                {
+                    "element": _to_text(captures["element"][idx]),
+                    "kind": int(captures["kind"][idx]),
+                    "population_alpha": float(captures["population_alpha"][idx]),
+                    "population_beta": float(captures["population_beta"][idx]),
+                    "charge": float(captures["charge"][idx]),
+                    "spin": float(captures["spin"][idx]),
+                }
+            )
+
+        return {
+            "per-atom": per_atom,
+            "total": {
+                "population_alpha": float(captures["total_population_alpha"][0]),
+                "population_beta": float(captures["total_population_beta"][0]),
+                "charge": float(captures["total_charge"][0]),
+                "spin": float(captures["total_spin"][0]),
+            },
+        }
 
-            result_dict["mulliken_population_analysis"] = {
-                "per-atom": per_atom,
-                "total": {
-                    "population_alpha": float(captures["total_population_alpha"][0]),
-                    "population_beta": float(captures["total_population_beta"][0]),
-                    "charge": float(captures["total_charge"][0]),
-                    "spin": float(captures["total_spin"][0]),
-                },
+    for idx in range(len(captures["atom"])):
+        per_atom.append(
+            {
+                "element": _to_text(captures["element"][idx]),
+                "kind": int(captures["kind"][idx]),
+                "population": float(captures["population"][idx]),
+                "charge": float(captures["charge"][idx]),
             }
+        )
+
+    return {
+        "per-atom": per_atom,
+        "total": {
+            "population": float(captures["total_population"][0]),
+            "charge": float(captures["total_charge"][0]),
+        },
+    }
+
+
+def _mulliken_step_arrays(match):
+    """Convert a match of CP2K_MULLIKEN_MATCH to per-atom arrays"""
+
+    import numpy as np
+
+    captures = match.capturesdict()
+
+    if captures.get("population_alpha"):
+        keys = ("population_alpha", "population_beta", "charge", "spin")
+    else:
+        keys = ("population", "charge")
+
+    return {
+        "mulliken_{}".format(key): np.array(captures[key], dtype=np.float64)
+        for key in keys
+    }
+
+
+def _mulliken_block_end(block):
+    # anchor, empty line, header, per-atom lines, total line
+    total = "# Total charge"
+    if isinstance(block[-1], six.binary_type):
+        total = total.encode("ascii")
+
+    if total in block[-1]:
+        return True
+
+    # the only empty line within the block is the one right after the anchor
+    return len(block) > 2 and not block[-1].strip()
+
+
+Cp2kOutputSection = namedtuple(
+    "Cp2kOutputSection",
+    ["anchor", "key", "pattern", "convert", "block_end", "step_arrays"],
+)
+
+# Sections of the CP2K output which are extracted with an expensive regex.
+# The cheap literal anchor marks the beginning of the block on which the pattern is run,
+# `block_end` tells whether the lines read so far contain the complete block,
+# `step_arrays` (if not None) converts a match to the arrays collected for every step.
+CP2K_OUTPUT_SECTIONS = (
+    Cp2kOutputSection(
+        anchor="OVERLAP MATRIX CONDITION NUMBER AT GAMMA POINT",
+        key="overlap_matrix_condition_number",
+        pattern=CP2K_CONDITION_NUMBER_MATCH,
+        convert=_condition_number_dict,
+        # fixed length: anchor, 2 headers and 3 lines of numbers
+        block_end=lambda block: len(block) == 6,
+        step_arrays=None,
+    ),
+    Cp2kOutputSection(
+        anchor="Mulliken Population Analysis",
+        key="mulliken_population_analysis",
+        pattern=CP2K_MULLIKEN_MATCH,
+        convert=_mulliken_dict,
+        block_end=_mulliken_block_end,
+        step_arrays=_mulliken_step_arrays,
+    ),
+)
+
+
+def _binary_section(section):
+    """Return a copy of the section for parsing the raw bytes of the output"""
+
+    return section._replace(
+        anchor=section.anchor.encode("ascii"),
+        pattern=re.compile(
+            section.pattern.pattern.encode("ascii"), section.pattern.flags & ~re.UNICODE
+        ),
+    )
+
+
+class _Cp2kOutputLiterals(object):
+    """Literals used to find the relevant lines in the CP2K output, as text or as bytes"""
+
+    # pylint: disable=too-few-public-methods
+
+    def __init__(self, binary):
+        def lit(text):
+            return text.encode("ascii") if binary else text
+
+        self.empty = lit("")
+        self.energy = lit(" ENERGY| ")
+        self.nwarnings = lit("The number of warnings for this run is")
+        self.walltime = lit("exceeded requested execution time")
+        self.bands = lit("KPOINTS| Band Structure Calculation")
+        self.timing = lit("T I M I N G")
+
+        if binary:
+            self.sections = tuple(_binary_section(s) for s in CP2K_OUTPUT_SECTIONS)
         else:
-            for idx in range(len(captures["atom"])):
-                per_atom.append(
-                    {
-                        "element": captures["element"][idx],
-                        "kind": int(captures["kind"][idx]),
-                        "population": float(captures["population"][idx]),
-                        "charge": float(captures["charge"][idx]),
-                    }
-                )
+            self.sections = CP2K_OUTPUT_SECTIONS
 
-            result_dict["mulliken_population_analysis"] = {
-                "per-atom": per_atom,
-                "total": {
-                    "population": float(captures["total_population"][0]),
-                    "charge": float(captures["total_charge"][0]),
-                },
-            }
 
-    return result_dict
+_TEXT_LITERALS = _Cp2kOutputLiterals(binary=False)
+_BINARY_LITERALS = _Cp2kOutputLiterals(binary=True)
 
 
-def _parse_bands(lines, n_start):
-    """Parse band structure from cp2k output"""
+class _BandsParser:
+    """
+    Line-by-line parser for the band structure section of the CP2K output.
 
-    import numpy as np
+    The eigenvalue blocks are converted in bulk into one (spin, kpoint, band) array,
+    which is grown by doubling its k-point capacity whenever it is full.
+    """
+
+    def __init__(self):
+        self.kpoints = None
+        self.bands = None
+        self.nkpoints = [0, 0]  # number of k-points read for each spin
+        self.labels = []
+        self.known_kpoints = {}
 
-    kpoints = []
-    labels = []
-    bands_s1 = []
-    bands_s2 = []
-    known_kpoints = {}
-    pattern = re.compile(".*?Nr.*?Spin.*?K-Point.*?", re.DOTALL)
-
-    selected_lines = lines[n_start:]
-    for current_line, line in enumerate(selected_lines):
-        splitted = line.split()
-        if "KPOINTS| Special K-Point" in line:
+        # state of the eigenvalue block currently being read
+        self._spin = None
+        self._kpoint = None
+        self._nbands = None
+        self._nlines = None
+        self._lines = []
+
+    @property
+    def in_block(self):
+        """Whether the parser is within an eigenvalue block"""
+        return self._spin is not None
+
+    def feed(self, line):
+        """Process the next line of the output"""
+
+        if self._spin is not None:
+            # the line after the block header has the number of bands
+            if self._nbands is None:
+                self._nbands = int(line)
+                self._nlines = int(math.ceil(self._nbands / 4))
+            else:
+                self._lines.append(line)
+                self._nlines -= 1
+
+            if self._nlines == 0:
+                self._add_band()
+
+            return
+
+        if line.startswith(" Nr.") and "K-Point" in line:
+            splitted = line.split()
+            self._spin = int(splitted[3])
+            self._kpoint = tuple(float(p) for p in splitted[-3:])
+        elif "KPOINTS| Special K-Point" in line:
+            splitted = line.split()
             kpoint = tuple(float(p) for p in splitted[-3:])
             if " ".join(splitted[-5:-3]) != "not specified":
                 label = splitted[-4]
-                known_kpoints[kpoint] = label
-        elif pattern.match(line):
-            spin = int(splitted[3])
-            kpoint = tuple(float(p) for p in splitted[-3:])
-            kpoint_n_lines = int(math.ceil(int(selected_lines[current_line + 1]) / 4))
-            band = [
-                float(v)
-                for v in " ".join(
-                    selected_lines[current_line + 2 : current_line + 2 + kpoint_n_lines]
-                ).split()
-            ]
-
-            if spin == 1:
-                if kpoint in known_kpoints:
-                    labels.append((len(kpoints), known_kpoints[kpoint]))
-                kpoints.append(kpoint)
-                bands_s1.append(band)
-            elif spin == 2:
-                bands_s2.append(band)
-
-    if bands_s2:
-        bands = [bands_s1, bands_s2]
-    else:
-        bands = bands_s1
+                self.known_kpoints[kpoint] = label
+
+    def _add_band(self):
+        import numpy as np
+
+        band = np.fromstring("".join(self._lines), sep=" ")
+
+        if self.bands is None:
+            self.kpoints = np.empty((64, 3))
+            self.bands = np.empty((2, 64, band.size))
+        elif band.size != self.bands.shape[2]:
+            raise ValueError("inconsistent number of bands in band structure")
+
+        ispin = self._spin - 1
+        ikpoint = self.nkpoints[ispin]
+
+        if ikpoint == self.bands.shape[1]:
+            self.kpoints = np.resize(self.kpoints, (2 * ikpoint, 3))
+            bands = np.empty((2, 2 * ikpoint, band.size))
+            bands[:, :ikpoint] = self.bands
+            self.bands = bands
+
+        self.bands[ispin, ikpoint] = band
+        self.nkpoints[ispin] += 1
 
-    return np.array(kpoints), labels, np.array(bands)
+        if self._spin == 1:
+            if self._kpoint in self.known_kpoints:
+                self.labels.append((ikpoint, self.known_kpoints[self._kpoint]))
+            self.kpoints[ikpoint] = self._kpoint
+
+        self._end_block()
+
+    def _end_block(self):
+        self._spin = None
+        self._kpoint = None
+        self._nbands = None
+        self._nlines = None
+        self._lines = []
+
+    def result(self):
+        """
+        Return the kpoints, labels and bands parsed so far. If the output ended within
+        the band structure (e.g. a killed run), the incomplete k-point is dropped.
+        """
+
+        import numpy as np
+
+        if self._spin is not None:  # the output ended within an eigenvalue block
+            self._end_block()
+
+        if self.bands is None:
+            return np.array([]), self.labels, np.array([])
+
+        nkpoints_s1, nkpoints_s2 = self.nkpoints
+
+        if not nkpoints_s2:
+            return self.kpoints[:nkpoints_s1], self.labels, self.bands[0, :nkpoints_s1]
+
+        # only the k-points with the bands of both spins
+        nkpoints = min(nkpoints_s1, nkpoints_s2)
+        labels = [
+            (ikpoint, label) for ikpoint, label in self.labels if ikpoint < nkpoints
+        ]
+
+        return self.kpoints[:nkpoints], labels, self.bands[:, :nkpoints]
+
+
+class _TimingParser:
+    """
+    Line-by-line parser for the timing report at the end of the CP2K output.
+
+    The rows are kept as lists of fields and converted in bulk into one array per column,
+    with NaN for the values not fitting into their column (like call counts > 9999999).
+    """
+
+    COLUMNS = (
+        "calls",
+        "asd",
+        "self_time_average",
+        "self_time_maximum",
+        "total_time_average",
+        "total_time_maximum",
+    )
+
+    def __init__(self):
+        self.in_table = True  # until the closing line of the table
+        self._in_rows = False
+        self._rows = []
+
+    def feed(self, line):
+        """Process the next line of the output"""
+
+        if not self._in_rows:
+            # the rows follow the second line of the column headers
+            self._in_rows = "MAXIMUM" in line
+            return
+
+        fields = line.split()
+
+        if not fields or fields[0].startswith("---"):  # the closing line
+            self.in_table = False
+        elif len(fields) == len(self.COLUMNS) + 1:
+            self._rows.append(fields)
+
+    def result(self):
+        """Return the subroutine names and the columns of the rows parsed so far"""
+
+        import numpy as np
+
+        rows = np.array(self._rows, dtype=six.text_type).reshape(
+            -1, len(self.COLUMNS) + 1
+        )
+
+        # the values exceeding their field width are printed as asterisks by CP2K
+        values = rows[:, 1:]
+        values[np.char.startswith(values, "*")] = "nan"
+        values = values.astype(np.float64)
+
+        result = {"subroutines": rows[:, 0]}
+        for idx, column in enumerate(self.COLUMNS):
+            result[column] = values[:, idx]
+
+        return result
+
+
+def _parse_bands(lines):
+    """Parse band structure from the lines of the cp2k output following the KPOINTS header"""
+
+    parser = _BandsParser()
+
+    for line in lines:
+        parser.feed(line)
+
+    return parser.result()
 
 
 def parse_cp2k_trajectory(fobj):
-    """CP2K trajectory parser"""
+    """
+    CP2K restart file structure reader.
+
+    The file is read line by line until the end of the first SUBSYS section.
+    Besides the symbols, positions and cell, the velocities (in atomic units),
+    the charges of the force field atom types and the elements of the kinds
+    are returned if present.
+    """
+
+    import numpy as np
+
+    symbols = []
+    coords = []
+    velocities = []
+    cell = {}
+    charges = {}
+    kinds = {}
+
+    path = []  # the names of the currently open sections
+    kind = None
+    charge = {}
+
+    for line in fobj:
+        stripped = line.strip()
+
+        if not stripped:
+            continue
+
+        if stripped.startswith("&"):
+            if stripped.upper().startswith("&END"):
+                name = path.pop()
+
+                if name == "SUBSYS":  # everything we need has been read
+                    break
+
+                if name == "CHARGE" and "ATOM" in charge:
+                    charges[charge["ATOM"]] = float(charge["CHARGE"])
+            else:
+                name, _, param = stripped[1:].partition(" ")
+                name = name.upper()
+                path.append(name)
+
+                if name == "KIND":
+                    kind = param.strip()
+                    kinds.setdefault(kind, kind)
+                elif name == "CHARGE":
+                    charge = {}
+            continue
+
+        section = path[-1] if path else None
+        in_subsys = len(path) > 1 and path[-2] == "SUBSYS"
+
+        if section == "COORD" and in_subsys:
+            fields = stripped.split()
+            symbols.append(fields[0])
+            coords += fields[1:4]
+        elif section == "VELOCITY" and in_subsys:
+            velocities.append(stripped)
+        elif section == "CELL" and in_subsys:
+            fields = stripped.split()
+            if fields[0] in ("A", "B", "C"):
+                cell[fields[0]] = fields[1:4]
+        elif section == "KIND" and in_subsys:
+            keyword, _, value = stripped.partition(" ")
+            if keyword.upper() == "ELEMENT":
+                kinds[kind] = value.strip()
+        elif section == "CHARGE":
+            keyword, _, value = stripped.partition(" ")
+            charge[keyword.upper()] = value.strip()
+
+    result = {
+        "symbols": symbols,
+        # converted in bulk from the flat list of all coordinate fields
+        "positions": np.array(coords, np.float64).reshape(-1, 3),
+        "cell": np.array([cell[v] for v in "ABC"], np.float64),
+        "kinds": kinds,
+    }
+
+    if velocities:
+        result["velocities"] = np.fromstring(" ".join(velocities), sep=" ").reshape(
+            -1, 3
+        )
+
+    if charges:
+        result["charges"] = charges
+
+    return result
+
+
+XYZ_BLOCK_FRAMES = 1024  # frames converted at once by parse_cp2k_xyz_trajectory
+
+
+def parse_cp2k_xyz_trajectory(fobj, stride=1):
+    """
+    Reader for the XYZ trajectories written by CP2K (positions, velocities or forces).
+
+    The given file object must be opened in binary mode. Only the lines of every `stride`-th
+    frame are kept, the frames in between are skipped. The kept frames are converted in blocks
+    of `XYZ_BLOCK_FRAMES` into preallocated arrays, which are doubled in size whenever full.
+    Returns the symbols, a (frames, atoms, 3) array of the values and the step numbers, times
+    and energies from the comment lines (NaN if not available). An empty file gives no frames.
+    """
 
     import numpy as np
 
-    # pylint: disable=protected-access
+    first_line = fobj.readline()
+    natoms = int(first_line) if first_line.strip() else 0
+    frame_lines = natoms + 2
+    skipped_lines = (stride - 1) * frame_lines
+
+    capacity = XYZ_BLOCK_FRAMES if natoms else 0
+    values = np.empty((capacity, natoms, 3))
+    steps = np.zeros(capacity, dtype=np.int64)
+    times = np.empty(capacity)
+    energies = np.empty(capacity)
+    symbols = []
+    nframes = 0
+
+    def grown(array, size):
+        result = np.empty((size,) + array.shape[1:], dtype=array.dtype)
+        result[:nframes] = array[:nframes]
+        return result
+
+    block = [first_line]
+    end_of_file = not natoms
+    while not end_of_file:
+        frame_start = len(block) - len(block) % frame_lines
+        block.extend(islice(fobj, frame_start + frame_lines - len(block)))
+
+        if len(block) < frame_start + frame_lines or not block[-1].endswith(b"\n"):
+            # an incomplete frame at the end of the file (e.g. a killed run)
+            del block[frame_start:]
+            end_of_file = True
+        else:
+            # skip the frames in between without keeping their lines
+            next(islice(fobj, skipped_lines, skipped_lines), None)
+
+        nblock = len(block) // frame_lines
+        if not nblock or (nblock < XYZ_BLOCK_FRAMES and not end_of_file):
+            continue
+
+        if nframes + nblock > capacity:
+            capacity = max(2 * capacity, nframes + nblock)
+            values, steps = grown(values, capacity), grown(steps, capacity)
+            times, energies = grown(times, capacity), grown(energies, capacity)
+
+        frames = np.array(block, dtype=object).reshape(nblock, frame_lines)
+
+        for iframe, comment in enumerate(frames[:, 1], nframes):
+            fields = dict(
+                (key.strip(), value)
+                for key, sep, value in (f.partition(b"=") for f in comment.split(b","))
+                if sep
+            )
+            steps[iframe] = int(fields.get(b"i", 0))
+            times[iframe] = float(fields.get(b"time", "nan"))
+            energies[iframe] = float(fields.get(b"E", "nan"))
+
+        atoms = b"".join(frames[:, 2:].ravel()).split()
+        atoms = np.array(atoms).reshape(nblock, natoms, -1)
+        values[nframes : nframes + nblock] = atoms[:, :, 1:4].astype(np.float64)
+
+        if not symbols:
+            symbols = [_to_text(s) for s in atoms[0, :, 0]]
+
+        nframes += nblock
+        block = []
+
+    return {
+        "symbols": symbols,
+        "values": values[:nframes],
+        "steps": steps[:nframes],
+        "times": times[:nframes],
+        "energies": energies[:nframes],
+    }
+
+
+def parse_dcd_trajectory(fobj, stride=1):
+    """
+    Reader for the binary (CHARMM) DCD trajectories written by CP2K.
+
+    The frames are not read one by one but mapped as an array of records from which
+    every `stride`-th frame is taken. Returns the (frames, atoms, 3) positions and,
+    if present in the file, the (frames, 3, 3) cells.
+    """
+
+    import numpy as np
+
+    # header: 'CORD' and 20 control integers, the title lines and the number of atoms
+    header = np.frombuffer(fobj.read(92), dtype="<i4")
+    if header[0] != 84 or header[1:2].tobytes() != b"CORD":
+        raise ValueError("not a DCD file (or not in little-endian byte order)")
+
+    has_cell = header[2 + 10] != 0
+    title_size = np.frombuffer(fobj.read(4), dtype="<i4")[0]
+    fobj.seek(title_size + 4, io.SEEK_CUR)
+    natoms = np.frombuffer(fobj.read(12), dtype="<i4")[1]
+
+    fields = []
+    if has_cell:
+        fields += [("cell_head", "<i4"), ("cell", "<f8", 6), ("cell_tail", "<i4")]
+    for axis in "xyz":
+        fields += [
+            (axis + "_head", "<i4"),
+            (axis, "<f4", (natoms,)),
+            (axis + "_tail", "<i4"),
+        ]
+    frame_dtype = np.dtype(fields)
+
+    offset = fobj.tell()
+    fobj.seek(0, io.SEEK_END)
+    nframes = (fobj.tell() - offset) // frame_dtype.itemsize
+
+    frames = np.memmap(
+        fobj, dtype=frame_dtype, mode="r", offset=offset, shape=(nframes,)
+    )[::stride]
+
+    result = {"positions": np.stack([frames["x"], frames["y"], frames["z"]], axis=-1)}
+
+    if has_cell:
+        # CP2K writes the cell as a, gamma, b, beta, alpha, c
+        # with the lengths in angstrom and the angles in degrees
+        lengths = frames["cell"][:, [0, 2, 5]]
+        cos_alpha, cos_beta, cos_gamma = np.cos(
+            np.radians(frames["cell"][:, [4, 3, 1]].T)
+        )
+        sin_gamma = np.sqrt(1.0 - cos_gamma ** 2)
+        c_y = (cos_alpha - cos_beta * cos_gamma) / sin_gamma
+        c_z = np.sqrt(1.0 - cos_beta ** 2 - c_y ** 2)
+
+        cells = np.zeros((len(frames), 3, 3))
+        cells[:, 0, 0] = 1.0
+        cells[:, 1, 0] = cos_gamma
+        cells[:, 1, 1] = sin_gamma
+        cells[:, 2, 0] = cos_beta
+        cells[:, 2, 1] = c_y
+        cells[:, 2, 2] = c_z
+        result["cells"] = cells * lengths[:, :, np.newaxis]
+
+    return result
+
+
+def tabulate_output_parameters(results):
+    """
+    Collect the scalar results (numbers and flags) of many calculations in a table.
+
+    Args:
+        results: a mapping of labels to the parsed output parameters (dictionaries)
+
+    Returns a dictionary with the sorted labels as array `labels` and a float array
+    for every scalar key found in any of the results, with NaN where it is missing.
+    """
+
+    import numpy as np
+
+    labels = sorted(results)
+    columns = {}
+
+    for row, label in enumerate(labels):
+        for key, value in results[label].items():
+            if isinstance(value, bool):
+                value = float(value)
+            elif not isinstance(value, six.integer_types + (float,)):
+                continue
+
+            if key not in columns:
+                columns[key] = np.full(len(labels), np.nan)
+            columns[key][row] = value
+
+    columns["labels"] = np.array(labels, dtype=six.text_type)
+
+    return columns
+
+
+def get_disk_cache(variable):
+    """
+    Return the DiskCache in the directory given by the environment variable, with the
+    maximal size in bytes given by the variable with the suffix _SIZE (default: 1 GiB),
+    or None if the variable is not set. The directory must be private to the AiiDA user,
+    since the cached data is trusted (the parse results are unpickled).
+    """
+
+    directory = os.environ.get(variable)
+    if not directory:
+        return None
+
+    max_size = int(os.environ.get(variable + "_SIZE", 1024 ** 3))
+    return DiskCache(directory, max_size)
+
+
+class DiskCache(object):
+    """
+    Content-addressed on-disk cache of binary data.
+
+    The entries are stored as files named by their key, the least recently used ones
+    are evicted when the total size exceeds `max_size` bytes. Since the eviction has to
+    scan the complete cache, it is only done after writing about EVICTION_INTERVAL times
+    `max_size` bytes: every put evicts with a probability proportional to its size.
+    This needs no shared state between the processes using the cache, but the cache
+    can exceed its maximal size by about this fraction.
+    """
+
+    EVICTION_INTERVAL = 0.1
+    TMP_PREFIX = ".tmp-"  # in-flight entries, never evicted
+
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], key)
+
+    def get(self, key):
+        """Return the data for the given key or None if not cached"""
+
+        path = self._path(key)
+
+        try:
+            with io.open(path, mode="rb") as fhandle:
+                data = fhandle.read()
+        except (IOError, OSError):
+            return None
+
+        # the modification time is used for the LRU order
+        try:
+            os.utime(path, None)
+        except OSError:  # evicted concurrently, the data is still valid
+            pass
+
+        return data
+
+    def delete(self, key):
+        """Remove the entry for the given key, if cached"""
+
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def put(self, key, data):
+        """Store the data for the given key and evict old entries if necessary"""
+
+        path = self._path(key)
+        dirname = os.path.dirname(path)
+
+        if not os.path.isdir(dirname):
+            try:
+                os.makedirs(dirname)
+            except OSError:  # created concurrently by another process
+                pass
+
+        # write to a temporary file first to never expose incomplete entries
+        fdesc, tmp_path = tempfile.mkstemp(prefix=self.TMP_PREFIX, dir=dirname)
+        with os.fdopen(fdesc, "wb") as fhandle:
+            fhandle.write(data)
+        os.rename(tmp_path, path)
+
+        if random.random() * self.EVICTION_INTERVAL * self.max_size < len(data):
+            self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache fits into max_size"""
+
+        entries = []
+        for dirpath, _, fnames in os.walk(self.directory):
+            for fname in fnames:
+                if fname.startswith(self.TMP_PREFIX):
+                    continue
+
+                path = os.path.join(dirpath, fname)
+                try:
+                    stat = os.stat(path)
+                except OSError:  # removed concurrently
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
 
-    content = fobj.read()
+        total_size = sum(size for _, size, _ in entries)
 
-    # parse coordinate section
-    match = re.search(r"\n\s*&COORD\n(.*?)\n\s*&END COORD\n", content, re.DOTALL)
-    coord_lines = [line.strip().split() for line in match.group(1).splitlines()]
-    symbols = [line[0] for line in coord_lines]
-    positions_str = [line[1:] for line in coord_lines]
-    positions = np.array(positions_str, np.float64)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
 
-    # parse cell section
-    match = re.search(r"\n\s*&CELL\n(.*?)\n\s*&END CELL\n", content, re.DOTALL)
-    cell_lines = [line.strip().split() for line in match.group(1).splitlines()]
-    cell_str = [line[1:] for line in cell_lines if line[0] in "ABC"]
-    cell = np.array(cell_str, np.float64)
+            try:
+                os.remove(path)
+            except OSError:
+                pass
 
-    return {"symbols": symbols, "positions": positions, "cell": cell}
+            total_size -= size
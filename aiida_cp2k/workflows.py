@@ -5,5 +5,822 @@
 # AiiDA-CP2K is hosted on GitHub at https://github.com/cp2k/aiida-cp2k        #
 # For further information on the license, see the LICENSE.txt file.           #
 ###############################################################################
+"""AiiDA-CP2K work chains"""
 
-# EOF
+from __future__ import absolute_import
+
+from copy import deepcopy
+from itertools import product
+import re
+
+import six
+
+from aiida.common import AttributeDict
+from aiida.engine import WorkChain, ToContext, append_, calcfunction, if_, while_
+from aiida.orm import ArrayData, Bool, Dict, Int, Str, StructureData
+
+from .calculations import Cp2kCalculation
+
+if six.PY2:
+    from collections import Mapping
+else:
+    from collections.abc import Mapping
+
+PARENT_RESTART_FILE_NAME = (
+    Cp2kCalculation._DEFAULT_PARENT_CALC_FLDR_NAME
+    + Cp2kCalculation._DEFAULT_RESTART_FILE_NAME
+)
+PARENT_WFN_FILE_NAME = (
+    Cp2kCalculation._DEFAULT_PARENT_CALC_FLDR_NAME
+    + Cp2kCalculation._DEFAULT_PROJECT_NAME
+    + "-RESTART.wfn"
+)
+
+
+def _dft_sections(params):
+    """Yield all DFT sections in the nested input parameters"""
+
+    for key, val in params.items():
+        for entry in val if isinstance(val, list) else [val]:
+            if not isinstance(entry, dict):
+                continue
+
+            if key.upper() == "DFT":
+                yield entry
+
+            for section in _dft_sections(entry):
+                yield section
+
+
+def add_wfn_restart(params):
+    """
+    Return a copy of the input parameters with all DFT sections starting
+    from the wavefunction of the calculation linked as parent_calc_folder.
+    """
+
+    params = deepcopy(params)
+
+    for section in _dft_sections(params):
+        section["RESTART_FILE_NAME"] = PARENT_WFN_FILE_NAME
+        section.setdefault("SCF", {})["SCF_GUESS"] = "RESTART"
+
+    return params
+
+
+def add_ext_restart(params):
+    """
+    Return a copy of the input parameters continuing the run (counters, coordinates,
+    velocities, wavefunction) of the calculation linked as parent_calc_folder.
+    """
+
+    params = add_wfn_restart(params)
+    params["EXT_RESTART"] = {"RESTART_FILE_NAME": PARENT_RESTART_FILE_NAME}
+
+    return params
+
+
+# the keyword limiting the outer loop of the run types, by the path below MOTION
+_RUN_TYPE_STEPS = {
+    "GEO_OPT": ("GEO_OPT", "MAX_ITER"),
+    "GEOMETRY_OPTIMIZATION": ("GEO_OPT", "MAX_ITER"),
+    "CELL_OPT": ("CELL_OPT", "MAX_ITER"),
+    "MD": ("MD", "STEPS"),
+    "MOLECULAR_DYNAMICS": ("MD", "STEPS"),
+}
+
+
+def add_benchmark_cap(params, max_scf):
+    """
+    Return a copy of the input parameters doing a single step of the outer loop
+    (geometry optimization, MD, band optimization) of the run type, which is kept,
+    with exactly max_scf SCF steps in every DFT section.
+    """
+
+    params = deepcopy(params)
+    run_type = params.get("GLOBAL", {}).get("RUN_TYPE", "ENERGY").upper()
+
+    if run_type == "BAND":
+        band = params.setdefault("MOTION", {}).setdefault("BAND", {})
+        optimize = band.setdefault("OPTIMIZE_BAND", {})
+        # the subsection of the optimizer selected by OPT_TYPE (default: DIIS)
+        optimizer = optimize.get("OPT_TYPE", "DIIS").upper()
+        optimize.setdefault(optimizer, {})["MAX_STEPS"] = 1
+    elif run_type in _RUN_TYPE_STEPS:
+        section, keyword = _RUN_TYPE_STEPS[run_type]
+        params.setdefault("MOTION", {}).setdefault(section, {})[keyword] = 1
+
+    for section in _dft_sections(params):
+        scf = section.setdefault("SCF", {})
+        scf["MAX_SCF"] = max_scf
+        scf["EPS_SCF"] = 1.0e-30  # never converged before the cap
+
+    return params
+
+
+def add_walltime(params, max_wallclock_seconds):
+    """
+    Return a copy of the input parameters with the GLOBAL/WALLTIME set to the given
+    scheduler limit minus a safety margin (5%, at least 60 s), such that CP2K stops
+    cleanly and writes its restart files, unless a walltime is already set.
+    """
+
+    params = deepcopy(params)
+    global_section = params.setdefault("GLOBAL", {})
+
+    if "WALLTIME" not in global_section:
+        margin = min(max(60, 0.05 * max_wallclock_seconds), 0.5 * max_wallclock_seconds)
+        global_section["WALLTIME"] = int(max_wallclock_seconds - margin)
+
+    return params
+
+
+def _validate_positive(value):
+    if value.value < 1:
+        return "the value must be a positive integer"
+
+    return None
+
+
+def _natural_key(label):
+    """Sort key ordering the numbers in the label by value, e.g. img_9 before img_10"""
+
+    return [int(part) if part.isdigit() else part for part in re.split(r"(\d+)", label)]
+
+
+def _split_sequence(labels, num_chains):
+    """Split the labels into num_chains contiguous parts of almost equal length"""
+
+    size, remainder = divmod(len(labels), num_chains)
+    chains = []
+    start = 0
+
+    for idx in range(num_chains):
+        end = start + size + (1 if idx < remainder else 0)
+        if end > start:
+            chains.append(labels[start:end])
+        start = end
+
+    return chains
+
+
+def _is_repeated_section(value):
+    return isinstance(value, list) and all(isinstance(e, dict) for e in value)
+
+
+def _merge_params(params, update):
+    """Return a copy of the input parameters with the sections and keywords of the update"""
+
+    params = deepcopy(params)
+
+    for key, val in update.items():
+        current = params.get(key)
+
+        if isinstance(val, dict) and isinstance(current, dict):
+            params[key] = _merge_params(current, val)
+        elif isinstance(val, dict) and _is_repeated_section(current):
+            # a repeated section, like multiple FORCE_EVALs, gets the update in every entry
+            params[key] = [_merge_params(entry, val) for entry in current]
+        else:
+            params[key] = deepcopy(val)
+
+    return params
+
+
+# the layout options which are job resources instead of input keywords
+RESOURCE_OPTIONS = ("num_machines", "num_mpiprocs_per_machine", "num_cores_per_mpiproc")
+
+
+def _validate_grid(grid):
+    for key, values in grid.get_dict().items():
+        if not isinstance(values, list) or not values:
+            return "the values for '{}' must be given as non-empty list".format(key)
+
+    return None
+
+
+def _validate_metric(metric):
+    if metric.value not in ("cost", "walltime"):
+        return "the metric must be 'cost' or 'walltime'"
+
+    return None
+
+
+def _grid_layouts(grid):
+    """Return all combinations of the values in the grid as list of dictionaries"""
+
+    keys = sorted(grid)
+    return [dict(zip(keys, values)) for values in product(*(grid[k] for k in keys))]
+
+
+def _plain_dict(mapping):
+    """Return a mutable copy of the (possibly frozen) nested mapping"""
+
+    return {
+        key: _plain_dict(val) if isinstance(val, Mapping) else deepcopy(val)
+        for key, val in mapping.items()
+    }
+
+
+def _apply_layout(inputs, layout):
+    """
+    Return a copy of the Cp2kCalculation inputs with the resources and input keywords
+    (given as paths like FORCE_EVAL/DFT/MGRID/NGRIDS) of the layout.
+    """
+
+    inputs = AttributeDict(inputs)
+    metadata = _plain_dict(inputs.get("metadata", {}))
+    options = metadata.setdefault("options", {})
+    params = inputs.parameters.get_dict()
+
+    for key, value in layout.items():
+        if key not in RESOURCE_OPTIONS:
+            update = value
+            for section in reversed(key.split("/")):
+                update = {section: update}
+            params = _merge_params(params, update)
+            continue
+
+        options.setdefault("resources", {})[key] = value
+
+        if key == "num_cores_per_mpiproc":  # the OpenMP threads
+            environment = options.setdefault("environment_variables", {})
+            environment["OMP_NUM_THREADS"] = str(value)
+
+    inputs.metadata = metadata
+    inputs.parameters = Dict(dict=params)
+
+    return inputs
+
+
+def _output_table(results):
+    """Return the ArrayData with the tabulated scalar results and the table columns"""
+    from .utils import tabulate_output_parameters
+
+    columns = tabulate_output_parameters(results)
+
+    table = ArrayData()
+    for name, array in columns.items():
+        table.set_array(name, array)
+
+    return table, columns
+
+
+@calcfunction
+def collect_output_parameters(**output_parameters):
+    """Collect the scalar results of the given output parameters as arrays in an ArrayData"""
+
+    table, _ = _output_table(
+        {label: node.get_dict() for label, node in output_parameters.items()}
+    )
+
+    return table
+
+
+@calcfunction
+def select_layout(layouts, metric, **output_parameters):
+    """
+    Return the benchmarked layout with the lowest cost (total time times number of
+    machines) or total time, and the table of the benchmark results including
+    the values of the layouts (as arrays named layout_<option or keyword path>).
+    """
+    import numpy as np
+
+    layouts = layouts.get_dict()
+    results = {label: node.get_dict() for label, node in output_parameters.items()}
+
+    best = None
+    for label in sorted(results):
+        total_time = results[label]["total_time"]
+        cost = total_time * layouts[label].get("num_machines", 1)
+        value = cost if metric.value == "cost" else total_time
+
+        if best is None or value < best[0]:
+            best = (value, dict(layouts[label], total_time=total_time, cost=cost))
+
+    table, columns = _output_table(results)
+
+    for key in sorted(set(k for label in results for k in layouts[label])):
+        table.set_array(
+            "layout_" + re.sub(r"\W+", "_", key),
+            np.array([layouts[label].get(key) for label in columns["labels"]]),
+        )
+
+    return {"output_layout": Dict(dict=best[1]), "output_benchmarks": table}
+
+
+class Cp2kBaseWorkChain(WorkChain):
+    """
+    Run a Cp2kCalculation and restart it from its restart and wavefunction files
+    as long as it stops due to the exceeded walltime.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super(Cp2kBaseWorkChain, cls).define(spec)
+
+        spec.expose_inputs(Cp2kCalculation, namespace="cp2k")
+        spec.input(
+            "max_iterations",
+            valid_type=Int,
+            default=Int(5),
+            validator=_validate_positive,
+            help="the maximum number of calculations (the first run and restarts)",
+        )
+
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_calculation)(
+                cls.run_calculation, cls.inspect_calculation
+            ),
+            cls.results,
+        )
+
+        spec.expose_outputs(Cp2kCalculation)
+
+        spec.exit_code(
+            300,
+            "ERROR_CALCULATION_FAILED",
+            message="The calculation did not finish successfully.",
+        )
+        spec.exit_code(
+            301,
+            "ERROR_MAXIMUM_ITERATIONS_EXCEEDED",
+            message="The walltime was still exceeded after the maximum number of restarts.",
+        )
+
+    def setup(self):
+        self.ctx.inputs = AttributeDict(self.exposed_inputs(Cp2kCalculation, "cp2k"))
+        self.ctx.iteration = 0
+        self.ctx.finished = False
+
+        # CP2K has to stop by itself before the job is killed by the scheduler,
+        # otherwise there is neither a parsable output nor a restart file
+        max_wallclock_seconds = (
+            self.ctx.inputs.get("metadata", {})
+            .get("options", {})
+            .get("max_wallclock_seconds")
+        )
+        self.ctx.parameters = self.ctx.inputs.parameters.get_dict()
+        if max_wallclock_seconds:
+            self.ctx.parameters = add_walltime(
+                self.ctx.parameters, max_wallclock_seconds
+            )
+            self.ctx.inputs.parameters = Dict(dict=self.ctx.parameters)
+
+    def should_run_calculation(self):
+        return not self.ctx.finished
+
+    def run_calculation(self):
+        self.ctx.iteration += 1
+
+        node = self.submit(Cp2kCalculation, **self.ctx.inputs)
+        self.report(
+            "launched Cp2kCalculation<{}> (iteration {})".format(
+                node.pk, self.ctx.iteration
+            )
+        )
+
+        return ToContext(calculations=append_(node))
+
+    def inspect_calculation(self):
+        calc = self.ctx.calculations[-1]
+
+        if not calc.is_finished_ok:
+            self.report("Cp2kCalculation<{}> failed".format(calc.pk))
+            return self.exit_codes.ERROR_CALCULATION_FAILED
+
+        if not calc.outputs.output_parameters.get_dict().get("exceeded_walltime"):
+            self.ctx.finished = True
+            return None
+
+        if self.ctx.iteration >= self.inputs.max_iterations.value:
+            self.report(
+                "Cp2kCalculation<{}> exceeded the walltime, no restarts left".format(
+                    calc.pk
+                )
+            )
+            return self.exit_codes.ERROR_MAXIMUM_ITERATIONS_EXCEEDED
+
+        self.report(
+            "Cp2kCalculation<{}> exceeded the walltime, restarting".format(calc.pk)
+        )
+
+        # the parameters of the first run are kept, only the restart is added
+        self.ctx.inputs.parameters = Dict(dict=add_ext_restart(self.ctx.parameters))
+        self.ctx.inputs.parent_calc_folder = calc.outputs.remote_folder
+
+        return None
+
+    def results(self):
+        self.out_many(self.exposed_outputs(self.ctx.calculations[-1], Cp2kCalculation))
+
+
+class Cp2kSequenceWorkChain(WorkChain):
+    """
+    Run a Cp2kCalculation for each of a sequence of related structures (ordered by label,
+    numbers in the labels by value), starting the SCF of every calculation from the
+    wavefunction of the previous one.
+    The sequence can be split into several chains running in parallel.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super(Cp2kSequenceWorkChain, cls).define(spec)
+
+        spec.expose_inputs(
+            Cp2kCalculation,
+            namespace="cp2k",
+            exclude=("structure", "parent_calc_folder"),
+        )
+        spec.input_namespace(
+            "structures",
+            valid_type=StructureData,
+            dynamic=True,
+            help="the structures, run in the natural order of their labels "
+            "(numbers compared by value: img_9 before img_10)",
+        )
+        spec.input(
+            "num_chains",
+            valid_type=Int,
+            default=Int(1),
+            validator=_validate_positive,
+            help="the number of chains the sequence is split into, run in parallel",
+        )
+
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_step)(cls.run_step, cls.inspect_step),
+            cls.results,
+        )
+
+        spec.output_namespace(
+            "output_parameters",
+            valid_type=Dict,
+            dynamic=True,
+            help="the results of the calculations by structure label",
+        )
+
+        spec.exit_code(
+            300,
+            "ERROR_CALCULATION_FAILED",
+            message="At least one of the calculations did not finish successfully.",
+        )
+
+    def setup(self):
+        self.ctx.chains = _split_sequence(
+            sorted(self.inputs.structures, key=_natural_key),
+            self.inputs.num_chains.value,
+        )
+        self.ctx.parents = [None] * len(self.ctx.chains)
+        self.ctx.step = 0
+        self.ctx.failed = []
+
+    def should_run_step(self):
+        return any(self.ctx.step < len(chain) for chain in self.ctx.chains)
+
+    def _current_labels(self):
+        for idx, chain in enumerate(self.ctx.chains):
+            if self.ctx.step < len(chain):
+                yield idx, chain[self.ctx.step]
+
+    def run_step(self):
+        calcs = {}
+
+        for idx, label in self._current_labels():
+            inputs = AttributeDict(self.exposed_inputs(Cp2kCalculation, "cp2k"))
+            inputs.structure = self.inputs.structures[label]
+
+            parent = self.ctx.parents[idx]
+            if parent is not None:
+                inputs.parameters = Dict(
+                    dict=add_wfn_restart(inputs.parameters.get_dict())
+                )
+                inputs.parent_calc_folder = parent.outputs.remote_folder
+
+            node = self.submit(Cp2kCalculation, **inputs)
+            self.report("launched Cp2kCalculation<{}> for {}".format(node.pk, label))
+            calcs["calc_" + label] = node
+
+        return ToContext(**calcs)
+
+    def inspect_step(self):
+        for idx, label in self._current_labels():
+            calc = self.ctx["calc_" + label]
+
+            if calc.is_finished_ok:
+                self.ctx.parents[idx] = calc
+            else:
+                # the next structure in this chain is started from scratch
+                self.report("Cp2kCalculation<{}> for {} failed".format(calc.pk, label))
+                self.ctx.parents[idx] = None
+                self.ctx.failed.append(label)
+
+        self.ctx.step += 1
+
+    def results(self):
+        self.out(
+            "output_parameters",
+            {
+                label: self.ctx["calc_" + label].outputs.output_parameters
+                for chain in self.ctx.chains
+                for label in chain
+                if label not in self.ctx.failed
+            },
+        )
+
+        if self.ctx.failed:
+            return self.exit_codes.ERROR_CALCULATION_FAILED
+
+        return None
+
+
+class Cp2kFanOutWorkChain(WorkChain):
+    """
+    Run a Cp2kCalculation for every variation of an input template, with at most
+    max_in_flight calculations at a time, and collect the results in a table.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super(Cp2kFanOutWorkChain, cls).define(spec)
+
+        spec.expose_inputs(Cp2kCalculation, namespace="cp2k")
+        spec.input_namespace(
+            "structures",
+            valid_type=StructureData,
+            dynamic=True,
+            required=False,
+            help="the structure of the variations by label (default: the template's)",
+        )
+        spec.input_namespace(
+            "parameters",
+            valid_type=Dict,
+            dynamic=True,
+            required=False,
+            help="the sections and keywords merged into the template parameters by label",
+        )
+        spec.input(
+            "max_in_flight",
+            valid_type=Int,
+            default=Int(100),
+            validator=_validate_positive,
+            help="the maximum number of calculations running at a time",
+        )
+
+        spec.outline(
+            cls.setup,
+            while_(cls.should_run_batch)(cls.run_batch, cls.inspect_batch),
+            cls.results,
+        )
+
+        spec.output(
+            "output_table",
+            valid_type=ArrayData,
+            help="the scalar results of the calculations, one row per variation label",
+        )
+
+        spec.exit_code(
+            300,
+            "ERROR_CALCULATION_FAILED",
+            message="At least one of the calculations did not finish successfully.",
+        )
+        spec.exit_code(
+            301,
+            "ERROR_NO_VARIATIONS",
+            message="Neither structures nor parameters variations were given.",
+        )
+
+    def setup(self):
+        labels = set(self.inputs.get("structures", {})) | set(
+            self.inputs.get("parameters", {})
+        )
+        if not labels:
+            return self.exit_codes.ERROR_NO_VARIATIONS
+
+        self.ctx.pending = sorted(labels, reverse=True)  # popped from the end
+        self.ctx.batch = []
+        self.ctx.succeeded = []
+        self.ctx.failed = []
+
+        return None
+
+    def should_run_batch(self):
+        return bool(self.ctx.pending)
+
+    def run_batch(self):
+        template = self.exposed_inputs(Cp2kCalculation, "cp2k")
+        structures = self.inputs.get("structures", {})
+        updates = self.inputs.get("parameters", {})
+
+        calcs = {}
+        self.ctx.batch = []
+
+        while (
+            self.ctx.pending and len(self.ctx.batch) < self.inputs.max_in_flight.value
+        ):
+            label = self.ctx.pending.pop()
+
+            inputs = AttributeDict(template)
+            if label in structures:
+                inputs.structure = structures[label]
+            if label in updates:
+                inputs.parameters = Dict(
+                    dict=_merge_params(
+                        inputs.parameters.get_dict(), updates[label].get_dict()
+                    )
+                )
+
+            node = self.submit(Cp2kCalculation, **inputs)
+            calcs["calc_" + label] = node
+            self.ctx.batch.append(label)
+
+        self.report(
+            "launched {} calculations, {} pending".format(
+                len(calcs), len(self.ctx.pending)
+            )
+        )
+
+        return ToContext(**calcs)
+
+    def inspect_batch(self):
+        for label in self.ctx.batch:
+            calc = self.ctx["calc_" + label]
+
+            if calc.is_finished_ok:
+                self.ctx.succeeded.append(label)
+            else:
+                self.report("Cp2kCalculation<{}> for {} failed".format(calc.pk, label))
+                self.ctx.failed.append(label)
+
+    def results(self):
+        self.out(
+            "output_table",
+            collect_output_parameters(
+                **{
+                    label: self.ctx["calc_" + label].outputs.output_parameters
+                    for label in self.ctx.succeeded
+                }
+            ),
+        )
+
+        if self.ctx.failed:
+            return self.exit_codes.ERROR_CALCULATION_FAILED
+
+        return None
+
+
+class Cp2kAutotuneWorkChain(WorkChain):
+    """
+    Benchmark the parallel layouts (MPI processes, OpenMP threads and input keywords
+    like NGRIDS) of a grid with a few SCF steps, and run the calculation with the best.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        super(Cp2kAutotuneWorkChain, cls).define(spec)
+
+        spec.expose_inputs(Cp2kCalculation, namespace="cp2k")
+        spec.input(
+            "grid",
+            valid_type=Dict,
+            validator=_validate_grid,
+            help="the values to benchmark for the resources ({}) or keyword paths".format(
+                ", ".join(RESOURCE_OPTIONS)
+            ),
+        )
+        spec.input(
+            "max_scf",
+            valid_type=Int,
+            default=Int(5),
+            validator=_validate_positive,
+            help="the number of SCF steps of the benchmark calculations",
+        )
+        spec.input(
+            "metric",
+            valid_type=Str,
+            default=Str("cost"),
+            validator=_validate_metric,
+            help="minimize the node time ('cost') or the time to solution ('walltime')",
+        )
+        spec.input(
+            "run_production",
+            valid_type=Bool,
+            default=Bool(True),
+            help="run the calculation with the best layout",
+        )
+
+        spec.outline(
+            cls.run_benchmarks,
+            cls.inspect_benchmarks,
+            if_(cls.should_run_production)(cls.run_production, cls.inspect_production),
+            cls.results,
+        )
+
+        spec.output(
+            "output_layout",
+            valid_type=Dict,
+            help="the best layout with its total time and cost of the benchmark",
+        )
+        spec.output(
+            "output_benchmarks",
+            valid_type=ArrayData,
+            help="the results of the benchmarks and their layouts (arrays layout_<key>)",
+        )
+        spec.expose_outputs(Cp2kCalculation, namespace="production")
+        spec.outputs["production"].required = False
+
+        spec.exit_code(
+            300,
+            "ERROR_CALCULATION_FAILED",
+            message="The production calculation did not finish successfully.",
+        )
+        spec.exit_code(
+            301,
+            "ERROR_NO_SUCCESSFUL_BENCHMARK",
+            message="None of the benchmark calculations finished successfully.",
+        )
+
+    def run_benchmarks(self):
+        self.ctx.inputs = self.exposed_inputs(Cp2kCalculation, "cp2k")
+        self.ctx.layouts = _grid_layouts(self.inputs.grid.get_dict())
+
+        benchmark_inputs = AttributeDict(self.ctx.inputs)
+        benchmark_inputs.parameters = Dict(
+            dict=add_benchmark_cap(
+                self.ctx.inputs.parameters.get_dict(), self.inputs.max_scf.value
+            )
+        )
+
+        calcs = {}
+        for idx, layout in enumerate(self.ctx.layouts):
+            node = self.submit(
+                Cp2kCalculation, **_apply_layout(benchmark_inputs, layout)
+            )
+            calcs["benchmark_{}".format(idx)] = node
+
+        self.report("launched {} benchmark calculations".format(len(calcs)))
+
+        return ToContext(**calcs)
+
+    def inspect_benchmarks(self):
+        results = {}
+        layouts = {}
+
+        for idx, layout in enumerate(self.ctx.layouts):
+            label = "benchmark_{}".format(idx)
+            calc = self.ctx[label]
+
+            if not calc.is_finished_ok:
+                self.report("benchmark Cp2kCalculation<{}> failed".format(calc.pk))
+                continue
+
+            output_parameters = calc.outputs.output_parameters
+            if "total_time" not in output_parameters.get_dict():
+                continue  # the timing report is missing
+
+            results[label] = output_parameters
+            # the number of machines is needed for the cost, even if not in the grid
+            layouts[label] = dict(
+                layout,
+                num_machines=calc.get_option("resources").get("num_machines", 1),
+            )
+
+        if not results:
+            return self.exit_codes.ERROR_NO_SUCCESSFUL_BENCHMARK
+
+        outputs = select_layout(
+            layouts=Dict(dict=layouts), metric=self.inputs.metric, **results
+        )
+
+        self.ctx.layout = outputs["output_layout"].get_dict()
+        self.report("best layout: {}".format(self.ctx.layout))
+
+        self.out_many(outputs)
+
+        return None
+
+    def should_run_production(self):
+        return self.inputs.run_production.value
+
+    def run_production(self):
+        layout = {
+            k: v for k, v in self.ctx.layout.items() if k not in ("total_time", "cost")
+        }
+        node = self.submit(Cp2kCalculation, **_apply_layout(self.ctx.inputs, layout))
+        self.report("launched production Cp2kCalculation<{}>".format(node.pk))
+
+        return ToContext(production=node)
+
+    def inspect_production(self):
+        if not self.ctx.production.is_finished_ok:
+            return self.exit_codes.ERROR_CALCULATION_FAILED
+
+        return None
+
+    def results(self):
+        if "production" in self.ctx:
+            self.out_many(
+                self.exposed_outputs(
+                    self.ctx.production, Cp2kCalculation, namespace="production"
+                )
+            )
@@ -31,6 +31,38 @@ def get_backend_str():
     )
 
 
+def pytest_addoption(parser):
+    parser.addoption(
+        "--benchmark",
+        action="store_true",
+        default=False,
+        help="run the benchmarks (marked with 'benchmark'), deselected by default",
+    )
+
+
+def pytest_configure(config):
+    config.addinivalue_line(
+        "markers", "benchmark: throughput and memory benchmark, run with --benchmark"
+    )
+
+
+def pytest_collection_modifyitems(config, items):
+    """deselect the benchmarks unless requested"""
+    if config.getoption("--benchmark"):
+        return
+
+    selected, deselected = [], []
+    for item in items:
+        if item.get_closest_marker("benchmark") is None:
+            selected.append(item)
+        else:
+            deselected.append(item)
+
+    if deselected:
+        config.hook.pytest_deselected(items=deselected)
+        items[:] = selected
+
+
 @pytest.fixture(scope="session", autouse=True)
 def aiida_profile():
     """setup a test profile for the duration of the tests"""